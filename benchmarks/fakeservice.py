@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+A stand-in backup service for the benchmarks. Archives are files in
+a local directory, so Centrifuge's own overhead can be measured
+without a real service account.
+
+    python benchmarks/fakeservice.py ROOT [--latency S] create ARCHIVE [FILE ...]
+    python benchmarks/fakeservice.py ROOT [--latency S] delete ARCHIVE [ARCHIVE ...]
+    python benchmarks/fakeservice.py ROOT [--latency S] list
+
+Each invocation sleeps for the given latency first, like a round trip
+to a remote service would. create writes the names and sizes of the
+top-level files it was given into ROOT/ARCHIVE and prints statistics
+the way ``tarsnap --print-stats`` does.
+"""
+import os
+import sys
+import time
+import argparse
+
+SPEC = """\
+benchfake:
+  var_bin: "{python} {script} {root} --latency {latency}"
+  cmd_create: "$var_bin create $archive_name"
+  cmd_delete: "$var_bin delete $archive_name"
+  cmd_delete_batch: "$var_bin delete [$archive_name]"
+  cmd_list: "$var_bin list"
+  stats:
+    size: '^This archive\\s+(\\d+)'
+    compressed: '^This archive\\s+\\d+\\s+(\\d+)'
+    new: '^New data\\s+\\d+\\s+(\\d+)'
+"""
+
+def spec(root,latency=0.0):
+  """ The service specification of a fake service keeping its archives in *root* """
+  return SPEC.format(python=sys.executable,script=os.path.abspath(__file__),
+                     root=root,latency=latency)
+
+def create(root,archive,files):
+  size = 0
+  lines = []
+  for path in files:
+    for name in (os.listdir(path) if os.path.isdir(path) else [path]):
+      entry = os.path.join(path,name) if os.path.isdir(path) else name
+      try:
+        entry_size = os.lstat(entry).st_size
+      except OSError:
+        continue
+      size += entry_size
+      lines.append("{0} {1}\n".format(entry_size,entry))
+
+  with open(os.path.join(root,archive),'w') as manifest:
+    manifest.writelines(lines)
+
+  print("                                       Total size  Compressed size")
+  print("This archive                            {0:>10}       {1:>10}".format(size,size // 2))
+  print("New data                                {0:>10}       {1:>10}".format(size // 10,size // 20))
+  return 0
+
+def delete(root,archives):
+  status = 0
+  for archive in archives:
+    try:
+      os.unlink(os.path.join(root,archive))
+    except OSError as e:
+      sys.stderr.write("{0}: {1}\n".format(archive,e.strerror))
+      status = 1
+  return status
+
+def list_archives(root):
+  for archive in sorted(os.listdir(root)):
+    print(archive)
+  return 0
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("root")
+  parser.add_argument("--latency",type=float,default=0.0)
+  parser.add_argument("command",choices=("create","delete","list"))
+  parser.add_argument("args",nargs="*")
+  args = parser.parse_args()
+
+  if args.latency > 0:
+    time.sleep(args.latency)
+  if not os.path.isdir(args.root):
+    os.makedirs(args.root)
+
+  if args.command == "create":
+    return create(args.root,args.args[0],args.args[1:])
+  if args.command == "delete":
+    return delete(args.root,args.args)
+  return list_archives(args.root)
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Measure Centrifuge's own overhead on a synthetic fleet of archives,
+backed by the local stand-in service in fakeservice.py.
+
+    python benchmarks/fleet.py [-a ARCHIVES] [-i INSTANCES] [-n REPEAT]
+                               [--latency S] [-j JOBS] [--sqlite]
+                               [--baseline OLD.json]
+
+Generates a configuration of ARCHIVES archives that each keep
+INSTANCES daily instances, and a state in which every archive already
+holds INSTANCES of them and is due again. Then times:
+
+state_parse
+  State.ParseFile on the generated YAML state.
+state_load
+  Opening and loading the state through its store (YAML, or SQLite
+  with --sqlite).
+config_load
+  Reading and validating the configuration, without the cache.
+config_validate
+  BackupConfig.validate on the already parsed configuration.
+services_load, services_load_cached
+  Centrifuge._load_services with the fake service, with a cold and a
+  warm service cache.
+state_dump
+  Writing the whole state back as YAML.
+run_backups
+  A complete ``run --all``: every archive creates an instance and
+  retires its oldest one. Each repeat starts from a fresh copy.
+
+Prints one JSON object with the parameters and each benchmark's
+timings in ms, plus the phases of the last run_backups as recorded in
+its run summary. With --baseline, each benchmark also gets the ratio of
+its median to the one in that earlier output.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+import yaml
+import fakeservice
+import centrifuge.centrifuge as cf
+from centrifuge import state
+from centrifuge import metrics
+from centrifuge import statestore
+from centrifuge.config import BackupConfig
+
+def timed(func,repeat,setup=None):
+  """ Time *func* *repeat* times, calling *setup* untimed before each """
+  samples = []
+  for _ in range(repeat):
+    if setup:
+      setup()
+    start = time.time()
+    func()
+    samples.append((time.time() - start) * 1000)
+  samples.sort()
+  return {
+    "min_ms": round(samples[0],2),
+    "median_ms": round(samples[len(samples) // 2],2),
+    "max_ms": round(samples[-1],2),
+    "repeat": repeat
+  }
+
+class Fleet(object):
+  """ A synthetic configuration, state and service in *workdir* """
+
+  def __init__(self,workdir,archives,instances,latency,sqlite):
+    self.workdir = workdir
+    self.sqlite = sqlite
+    self.remote = os.path.join(workdir,"remote")
+    self.sources = os.path.join(workdir,"src")
+    self.services = os.path.join(workdir,"services")
+    self.config = os.path.join(workdir,"backups.yaml")
+    self.uservars = os.path.join(workdir,"user.vars")
+    self.template = os.path.join(workdir,"template")
+    self.data = os.path.join(workdir,"data")
+    self.yaml_state = os.path.join(self.template,"state")
+
+    for path in (self.remote,self.sources,self.services,self.template):
+      os.makedirs(path)
+    for n in range(20):
+      with open(os.path.join(self.sources,"file{0:02d}".format(n)),'w') as source:
+        source.write("x" * (1024 * (n + 1)))
+    with open(os.path.join(self.services,"benchfake.spec"),'w') as specfile:
+      specfile.write(fakeservice.spec(self.remote,latency))
+    # So the built-in services load as they would on a real host.
+    with open(self.uservars,'w') as uservars:
+      yaml.safe_dump({'tarsnap': {'user_config': ''}},uservars)
+
+    names = ["bench{0:05d}".format(n) for n in range(archives)]
+    with open(self.config,'w') as configfile:
+      yaml.safe_dump(dict((name,{'files': [self.sources],
+                                 'service': 'benchfake',
+                                 'daily': instances})
+                          for name in names),configfile)
+
+    # Every archive holds a full daily tier, the newest a day old.
+    now = datetime.datetime.now().replace(microsecond=0)
+    self.states = {}
+    for name in names:
+      bstate = state.State(name)
+      for age in range(instances,0,-1):
+        instance = state.BackupInstance(name,'daily',now - datetime.timedelta(days=age))
+        bstate['daily'].append(instance)
+        bstate['last_daily'] = instance
+        open(os.path.join(self.remote,str(instance)),'w').close()
+      self.states[name] = bstate
+
+    statestore.YAMLStateStore(self.yaml_state).flush(self.states)
+    if sqlite:
+      statestore.SQLiteStateStore(os.path.join(self.template,"state.db")).import_states(self.states)
+      os.rename(self.yaml_state,self.yaml_state + ".migrated")
+      self.yaml_state += ".migrated"
+    self.remote_template = self.remote + ".template"
+    shutil.copytree(self.remote,self.remote_template)
+
+  def reset(self):
+    """ Put the data directory and the service's archives back as generated """
+    for path,template in ((self.data,self.template),(self.remote,self.remote_template)):
+      if os.path.exists(path):
+        shutil.rmtree(path)
+      shutil.copytree(template,path)
+
+  def centrifuge(self):
+    """ A Centrifuge that keeps everything in this fleet's data directory """
+    data = self.data
+    class BenchCentrifuge(cf.Centrifuge):
+      DATA_DIR = data
+      STATEFILE = os.path.join(data,"state")
+      STATE_DB = os.path.join(data,"state.db")
+      DELETION_QUEUE = os.path.join(data,"deletions")
+      RUN_SUMMARY = os.path.join(data,"last_run.json")
+      USER_SPEC_DIR = os.path.join(data,"user")
+      ADDL_SERVICE_DIRS = [self.services]
+    centrifuge = BenchCentrifuge()
+    centrifuge.config_file = self.config
+    return centrifuge
+
+def run_benchmarks(fleet,args):
+  results = {}
+
+  results['state_parse'] = timed(lambda: state.State.ParseFile(fleet.yaml_state),args.repeat)
+
+  fleet.reset()
+  results['state_load'] = timed(
+      lambda: statestore.open_store(os.path.join(fleet.data,"state"),
+                                    os.path.join(fleet.data,"state.db")).load(),
+      args.repeat)
+
+  results['config_load'] = timed(lambda: BackupConfig(fleet.config),args.repeat)
+  loaded = yaml.safe_load(open(fleet.config))
+  results['config_validate'] = timed(lambda: BackupConfig.validate(loaded),args.repeat)
+
+  centrifuge = fleet.centrifuge()
+  cache = centrifuge._userpath(centrifuge.SERVICE_CACHE)
+  def drop_service_cache():
+    if os.path.exists(cache):
+      os.unlink(cache)
+  results['services_load'] = timed(lambda: centrifuge.load_services(fleet.uservars),
+                                   args.repeat,setup=drop_service_cache)
+  results['services_load_cached'] = timed(lambda: centrifuge.load_services(fleet.uservars),
+                                          args.repeat)
+
+  dump_path = os.path.join(fleet.workdir,"dump")
+  results['state_dump'] = timed(lambda: statestore.YAMLStateStore(dump_path).flush(fleet.states),
+                                args.repeat)
+
+  outcomes = []
+  runs = {}
+  def fresh_run():
+    fleet.reset()
+    metrics.reset()
+    runs['centrifuge'] = centrifuge = fleet.centrifuge()
+    centrifuge.services = centrifuge.load_services(fleet.uservars)
+  def run_all():
+    run_args = argparse.Namespace(all=True,backup_name=[],jobs=args.jobs,
+                                  stagger=None,dry_run=False)
+    outcomes.append(runs['centrifuge'].run_backups(args=run_args))
+  results['run_backups'] = timed(run_all,args.repeat,setup=fresh_run)
+
+  with open(runs['centrifuge'].RUN_SUMMARY) as summary:
+    phases = json.load(summary)['phases']
+  return results,phases,all(outcomes)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("-a","--archives",type=int,default=200)
+  parser.add_argument("-i","--instances",type=int,default=10)
+  parser.add_argument("-n","--repeat",type=int,default=3)
+  parser.add_argument("-j","--jobs",type=int,default=1)
+  parser.add_argument("--latency",type=float,default=0.0,
+                      help="Seconds every fake service call takes")
+  parser.add_argument("--sqlite",action="store_true",help="Keep the state in SQLite")
+  parser.add_argument("--baseline",help="Earlier output to compare against")
+  parser.add_argument("--keep",action="store_true",help="Keep the generated fleet")
+  args = parser.parse_args()
+
+  logging.getLogger('centrifuge').setLevel(logging.ERROR)
+  workdir = tempfile.mkdtemp(prefix="centrifuge-bench-")
+  try:
+    fleet = Fleet(workdir,args.archives,args.instances,args.latency,args.sqlite)
+    results,phases,ok = run_benchmarks(fleet,args)
+  finally:
+    if args.keep:
+      sys.stderr.write("Fleet kept in {0}\n".format(workdir))
+    else:
+      shutil.rmtree(workdir)
+
+  if args.baseline:
+    with open(args.baseline) as baseline:
+      previous = json.load(baseline)['results']
+    for name,timing in results.iteritems():
+      if name in previous and previous[name]['median_ms']:
+        timing['vs_baseline'] = round(timing['median_ms'] / previous[name]['median_ms'],3)
+
+  output = {
+    "params": {
+      "archives": args.archives,
+      "instances": args.instances,
+      "jobs": args.jobs,
+      "latency": args.latency,
+      "store": "sqlite" if args.sqlite else "yaml",
+      "python": sys.version.split()[0]
+    },
+    "results": results,
+    "run_phases": phases,
+    "run_ok": ok
+  }
+  json.dump(output,sys.stdout,indent=2,sort_keys=True)
+  sys.stdout.write("\n")
+  return 0 if ok else 1
+
+if __name__ == '__main__':
+  sys.exit(main())
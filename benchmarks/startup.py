@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Measure how long centrifuge takes to start up for its lightweight
+commands. Each command runs in a fresh interpreter, since import and
+resource loading cost is what we're after.
+
+    python benchmarks/startup.py [-n REPEAT] [-- extra centrifuge args]
+
+Prints one JSON object mapping each command to its timings in ms.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+  "import": None,
+  "help": ["--help"],
+  "state_list": ["state","--list"],
+  "list_services": ["list_services"],
+}
+
+LAUNCHER = ("import sys; sys.path.insert(0, {0!r}); "
+            "sys.argv = ['centrifuge'] + sys.argv[1:]; "
+            "import centrifuge.centrifuge as c; "
+            "c.run() if len(sys.argv) > 1 else None")
+
+def time_command(argv,repeat):
+  samples = []
+  with open(os.devnull,'w') as devnull:
+    for _ in range(repeat):
+      start = time.time()
+      subprocess.call([sys.executable,"-c",LAUNCHER.format(ROOT)] + argv,
+                      stdout=devnull,stderr=devnull)
+      samples.append((time.time() - start) * 1000)
+  samples.sort()
+  return {
+    "min_ms": round(samples[0],2),
+    "median_ms": round(samples[len(samples) // 2],2),
+    "max_ms": round(samples[-1],2),
+    "repeat": repeat
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("-n","--repeat",type=int,default=10)
+  parser.add_argument("extra",nargs="*",help="Extra arguments for every command")
+  args = parser.parse_args()
+
+  results = {}
+  for name,argv in sorted(COMMANDS.items()):
+    results[name] = time_command((argv or []) + (args.extra if argv else []),args.repeat)
+
+  json.dump(results,sys.stdout,indent=2,sort_keys=True)
+  sys.stdout.write("\n")
+
+if __name__ == '__main__':
+  main()
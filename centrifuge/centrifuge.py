@@ -1,10 +1,11 @@
 import os
 import sys
+import json
+import time
 import datetime
 import yaml
 import logging
 import logging.handlers
-import pkg_resources
 
 logging.basicConfig(level=logging.INFO,format='%(name)-12s: %(levelname)-8s %(message)s')
 log = logging.getLogger('centrifuge')
@@ -12,8 +13,21 @@ log = logging.getLogger('centrifuge')
 formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
 
 import service
-from config import BackupConfig,ServiceNotAvailableError
+from config import BackupConfig,ServiceNotAvailableError,InvalidConfigurationError
+from executor import WorkerPool
+from deletion import DeletionQueue
+from registry import ServiceRegistryCache
+from inventory import InventoryCache
 import state
+import util
+import runner
+import planner
+import intervals
+import inventory
+import metrics
+import profiling
+import changes
+import excludes
 
 class CentrifugeFatalError(Exception):
   pass
@@ -21,30 +35,28 @@ class CentrifugeFatalError(Exception):
 class Centrifuge(object):
 
   DATA_DIR = "/var/lib/centrifuge"
-  DEFAULT_SERVICES = [(service,pkg_resources.resource_string(__name__,"data/services/{0}".format(service)))
-                          for service
-                          in pkg_resources.resource_listdir(__name__,"data/services")
-                     ]
+  _default_services = None
   ADDL_SERVICE_DIRS = [ os.path.expanduser("~/.centrifuge/services"),
                         "/etc/centrifuge/services"
                       ]
   USER_SPEC_DIR = os.path.expanduser("~/.centrifuge")
+  SERVICE_CACHE = "cache/services"
+  CONFIG_CACHE = "cache/config"
+  INVENTORY_CACHE = "cache/inventory"
 
   STATEFILE = "{0}/state".format(DATA_DIR)
-  TIMEDELTAS = {
-    'daily': datetime.timedelta(days=1),
-    'weekly': datetime.timedelta(days=7),
-    'monthly': datetime.timedelta(days=30)
-  }
+  STATE_DB = "{0}/state.db".format(DATA_DIR)
+  DELETION_QUEUE = "{0}/deletions".format(DATA_DIR)
+  RUN_SUMMARY = "{0}/last_run.json".format(DATA_DIR)
+  CHANGE_INDEX = "{0}/changes".format(DATA_DIR)
 
   def config_required(func):
     def _decorator( self, *args, **kwargs):
       if not self.config_file:
         raise CentrifugeFatalError('Configuration file required for this command')
 
-      self.config = BackupConfig(self.config_file)
-      self.config.check_services(self.supported_services())
-      func(self,*args, **kwargs)
+      self.config = self.load_config()
+      return func(self,*args, **kwargs)
     return _decorator
 
 
@@ -52,6 +64,36 @@ class Centrifuge(object):
   def _userpath(cls,path):
     return "{0}/{1}".format(cls.USER_SPEC_DIR,path)
 
+  @classmethod
+  def default_services(cls):
+    """
+    The built-in service specifications as (filename, spec) pairs.
+    Read on first use, since pkg_resources is slow to import.
+    """
+    if cls._default_services is None:
+      import pkg_resources
+      cls._default_services = [(service,pkg_resources.resource_string(__name__,"data/services/{0}".format(service)))
+                                  for service
+                                  in pkg_resources.resource_listdir(__name__,"data/services")
+                              ]
+    return cls._default_services
+
+  def load_config(self):
+    """ Load and check the configuration in self.config_file """
+    with metrics.phase("config_load"):
+      config = BackupConfig(self.config_file,
+                            cache_path=self._userpath(self.CONFIG_CACHE))
+      config.check_services(self.supported_services())
+    return config
+
+  def load_services(self,uservars_path):
+    """ Load every service we know of, with the user variables in *uservars_path* """
+    with metrics.phase("services_load"):
+      user_spec_vars = self._load_user_vars(uservars_path)
+      # Look for services in our additional locations.
+      addl_svc_dir = filter( os.path.exists, self.ADDL_SERVICE_DIRS)
+      return self._load_services(user_spec_vars,addl_svc_dir)
+
   def supported_services(self,printout=False):
     if printout:
       print("Supported Services:")
@@ -60,67 +102,479 @@ class Centrifuge(object):
     return [srv.name for srv in self.services.itervalues()]
 
   def __init__(self):
-    self._setup_datadir()
+    self._store = None
+    self._due_index = None
+    self._changes = None
+    self.services = {}
+    self.metrics_file = None
+    self.profile_dir = None
+
+  @property
+  def store(self):
+    """ The state store, opened on first use """
+    with state.lock:
+      if self._store is None:
+        self._setup_datadir()
+      return self._store
+
+  @property
+  def state(self):
+    self.store
+    return self._state
+
+  @property
+  def deletions(self):
+    self.store
+    return self._deletions
+
+  @property
+  def due_index(self):
+    """ When each archive next falls due, loaded on first use """
+    with state.lock:
+      if self._due_index is None:
+        self._due_index = self.store.load_schedule()
+      return self._due_index
+
+  @property
+  def changes(self):
+    """ What the files of skip_unchanged archives looked like, loaded on first use """
+    with state.lock:
+      if self._changes is None:
+        self._changes = changes.ChangeIndex.Load(self.CHANGE_INDEX)
+      return self._changes
+
+  def checked(self,backup_name):
+    """
+    When each interval of *backup_name* was last found unchanged, if
+    it skips unchanged archives.
+    """
+    bconfig = self.config.targets().get(backup_name)
+    if not bconfig or not bconfig.get('skip_unchanged',False):
+      return {}
+    with state.lock:
+      return dict(self.changes.checked(backup_name))
 
   @config_required
   def run_backups(self,*args,**kwargs):
     cm_args = kwargs['args']
-    success = []
-    for backup in cm_args.backup_name:
-      log.info("Running backup '{0}'".format(backup))
-      success.append(self.run_backup(backup))
-      if not success[-1]:
-        log.info("'{0}' was not completely successful".format(backup))
-
-    return all(success)
-
-  def run_backup(self,backup_name):
-    try:
-      backup_config = self.config[backup_name]
-    except KeyError as e:
-      log.warn("No configured backup with name '{0}'".format(backup_name))
+    pool = WorkerPool(getattr(cm_args,"jobs",1))
+    backups = cm_args.backup_name
+    window = getattr(cm_args,"stagger",None)
+    dry_run = getattr(cm_args,"dry_run",False)
+    start = time.time()
+
+    if getattr(cm_args,"all",False):
+      if backups:
+        raise CentrifugeFatalError("Give either --all or archive names, not both")
+      if dry_run:
+        # Reconciling would write the due index, so plan every archive
+        # from its state instead; those with nothing due drop out.
+        backups = sorted(self.config.targets())
+      else:
+        self.reconcile_schedule()
+        backups = self.due_index.due(datetime.datetime.now())[0]
+        log.info("{0} of {1} archives are due".format(len(backups),len(self.config.targets())))
+    elif not backups:
+      raise CentrifugeFatalError("Name the archives to run, or use --all")
     else:
+      backups = self.expand_targets(backups)
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    plan = self.plan(backups,now,reschedule=not dry_run)
+    if dry_run:
+      print(plan.to_json(self.state))
+      return True
+
+    if window:
+      # Start the earliest slots first, so a small pool isn't stuck
+      # waiting on a late slot while an early one could run. Slots are
+      # the archive's, shared by all of its targets.
+      targets = self.config.targets()
+      plan.archives.sort(key=lambda archive: util.stagger_offset(
+                                                 targets[archive.backup]['archive'],window))
+
+    before = (lambda backup: self.stagger(backup,start,window)) if window else None
+    results = self.apply_plan(plan,pool,before)
+    # Deletes that failed are still queued.
+    return (all(results.itervalues()) and not len(self.deletions)
+            and all(backup in self.config.targets() for backup in backups))
+
+  def expand_targets(self,names):
+    """
+    The targets of the archives named in *names*: each of an archive's
+    services, or just the one if a name is already a target's key.
+    """
+    targets = []
+    for name in names:
+      if name in self.config:
+        targets.extend(self.config.targets_of(name))
+      else:
+        targets.append(name)
+    return targets
 
-      try:
-        backup_state = self.state[backup_name]
-      except KeyError:
-        self.state[backup_name] = state.State(backup_name)
-        backup_state = self.state[backup_name]
-
-      bservice = self.services[ backup_config['service'] ]
-      ok_daily = self.try_backup(bservice,backup_config,backup_state,"daily")
-      ok_weekly = self.try_backup(bservice,backup_config,backup_state,"weekly")
-      ok_monthly = self.try_backup(bservice,backup_config,backup_state,"monthly")
-
-      with open(self.STATEFILE,'w') as statef:
-        yaml.dump(self.state,statef)
+  def plan(self,backups,now,reschedule=True):
+    """
+    Plan a run of *backups* at *now*. Archives with nothing due are
+    rescheduled, so a stale due index can't keep offering them, unless
+    *reschedule* is False.
+    """
+    # Load the state first, so that it is timed on its own.
+    self.store
+    with metrics.phase("plan"):
+      plan = planner.make_plan(self.config.targets(),self.state,backups,now,self.checked)
+      planned = set(archive.backup for archive in plan)
+      for backup in backups:
+        if reschedule and backup in self.config.targets() and backup not in planned:
+          self.reschedule(backup)
+    log.info("Planned {0} archives to create across {1} backups".format(
+                sum(len(archive.creates) for archive in plan),len(plan)))
+    return plan
+
+  def apply_plan(self,plan,pool,before=None):
+    """
+    Carry out *plan*. Every archive's creates run on *pool* first
+    (calling *before* with the archive's name ahead of them, if given,
+    and planning the archive again once it returns), and then
+    everything they retired is deleted in one batch per service. An
+    archive backed up to several services runs the creates of each of
+    them at the same time.
+
+    Returns a dict of targets to whether all their creates succeeded.
+    The run's metrics are written out at the end.
+    """
+    targets = self.config.targets()
+
+    def _apply_target(archive,created=None):
+      log.info("Running backup '{0}'".format(archive.backup))
+      # Workers are threads of their own, so profile them as part of
+      # the create phase too.
+      with profiling.section("create"):
+        ok = self.apply_archive(archive,created)
+      if not ok:
+        log.info("'{0}' was not completely successful".format(archive.backup))
+      return ok
+
+    def _replan(archive):
+      now = datetime.datetime.now().replace(microsecond=0)
+      replanned = planner.plan_archive(archive.backup,targets[archive.backup],
+                                       self.state.get(archive.backup),now,
+                                       self.checked(archive.backup))
+      if not replanned:
+        log.info("Nothing is due for '{0}' any more".format(archive.backup))
+        self.reschedule(archive.backup)
+      return replanned
+
+    def _apply(group):
+      if before:
+        before(targets[group[0].backup]['archive'])
+        # The plan was made before the wait, so work out again what
+        # is due now that the archive actually starts.
+        group = [_replan(archive) for archive in group]
+      todo = [archive for archive in group if archive]
+      if len(todo) <= 1:
+        oks = [_apply_target(archive) for archive in todo]
+      else:
+        # Each service gets a worker of its own, so a slow one doesn't
+        # hold up the others, and the copies all get the same name.
+        created = datetime.datetime.now().replace(microsecond=0)
+        oks = WorkerPool(len(todo)).map(lambda archive: _apply_target(archive,created),todo)
+      done = dict(zip([archive.backup for archive in todo],oks))
+      return [done.get(archive.backup,True) for archive in group]
+
+    groups = {}
+    for archive in plan:
+      groups.setdefault(targets[archive.backup]['archive'],[]).append(archive)
+    ordered = sorted(groups.itervalues(),key=lambda group: plan.archives.index(group[0]))
+
+    results = {}
+    with metrics.phase("create"):
+      for group,oks in zip(ordered,pool.map(_apply,ordered)):
+        if not isinstance(oks,list):
+          oks = [False] * len(group)
+        results.update(zip([archive.backup for archive in group],oks))
+    # A due time that is stale only costs a wasted check next time, so
+    # the index is written once rather than after every archive.
+    with metrics.phase("schedule_flush"):
+      self.store.flush_schedule(self.due_index)
+    if self._changes is not None:
+      self._changes.save()
+    self.invalidate_inventory(results)
+
+    if len(self.deletions):
+      log.info("Deleting {0} retired archives".format(len(self.deletions)))
+      with metrics.phase("delete"):
+        if not self.deletions.drain(self.services):
+          log.warn("Some archives couldn't be deleted. They will be retried next run")
+    self.write_metrics(results)
+    return results
+
+  def apply_archive(self,archive,created=None):
+    """
+    Run the creates planned for one archive target. Whatever a
+    successful create retires is untagged, and queued for deletion
+    once no interval keeps it any more. New instances are named after
+    *created*, if given.
+
+    If the archive skips unchanged archives and its files look the
+    same as when its latest instance was created, that instance is
+    tagged into the due intervals instead of creating a new one.
+    """
+    bconfig = self.config.targets()[archive.backup]
+    bservice = self.services[archive.service]
+    exclusions = excludes.compile(bconfig.get('exclude'))
+    with state.lock:
+      if archive.backup not in self.state:
+        self.state[archive.backup] = self.store.create(archive.backup)
+      bstate = self.state[archive.backup]
+      if bconfig['archive'] != archive.backup:
+        bstate.archive_name = bconfig['archive']
+
+    start = time.time()
+    okay = True
+    retired = []
+    current = reuse = None
+    if bconfig.get('skip_unchanged',False):
+      with metrics.phase("scan"):
+        current = changes.fingerprint(bconfig['files'],excludes=exclusions)
+      with state.lock:
+        reuse = self._held_instance(bstate,self.changes.unchanged(archive.backup,current))
+
+    for create in archive.creates:
+      if reuse is not None:
+        retire = self._reuse_instance(archive.backup,bstate,reuse,create)
+      else:
+        if not bservice.add(create.interval,bstate,bconfig['files'],exclusions,created):
+          okay = False
+          continue
+
+        newest = bstate["last_{0}".format(create.interval)]
+        for interval in create.tags:
+          bstate.tag_instance(newest,interval)
+          log.info("Promoted {0} to '{1}'".format(newest,interval))
+        retire = create.retire
+
+        if current is not None:
+          with state.lock:
+            self.changes.record(archive.backup,current,newest)
+          # Nothing can have changed for the rest of this run's creates.
+          reuse = newest
+
+      by_interval = {}
+      for interval,instance in retire:
+        by_interval.setdefault(interval,[]).append(instance)
+      for interval,instances in by_interval.iteritems():
+        bstate.remove_instances(interval,instances)
+        retired.extend(instances)
+
+    if retired:
+      held = set(str(instance) for interval in bstate.intervals()
+                               for instance in bstate[interval])
+      doomed = dict((str(instance),instance) for instance in retired
+                    if str(instance) not in held)
+      kept = set(str(instance) for instance in retired) - set(doomed)
+      if kept:
+        log.info("Untagged {0}. Still held by another interval".format(", ".join(sorted(kept))))
+      if doomed:
+        self.deletions.push_many(bservice.name,
+                                 sorted(doomed.values(),key=lambda instance: instance.created_at))
+
+    self.reschedule(archive.backup)
+    with metrics.phase("state_flush"):
+      self.store.flush(self.state)
+    metrics.record_archive(archive.backup,okay,time.time() - start)
+    return okay
 
-      return all((ok_monthly,ok_daily,ok_weekly))
+  def write_metrics(self,results):
+    """
+    Write the current run's metrics to RUN_SUMMARY as JSON and, if a
+    metrics file was given, to that as a Prometheus textfile. *results*
+    maps the archives that ran to whether they succeeded.
+    """
+    last_created = {}
+    for name,bconfig in self.config.targets().iteritems():
+      bstate = self.state.get(name)
+      checked = self.checked(name)
+      for interval in intervals.configured(bconfig):
+        created = planner.latest_created(bstate,interval,checked)
+        if created is not None:
+          last_created[(name,interval.name)] = intervals.as_datetime(created)
+
+    recorder = metrics.current()
+    summary = recorder.summary(all(results.itervalues()) and not len(self.deletions),
+                               last_created)
+    if self.profile_dir:
+      summary['profile'] = self.profile_dir
+    try:
+      metrics.write_atomic(self.RUN_SUMMARY,json.dumps(summary,indent=2,sort_keys=True))
+      if self.metrics_file:
+        metrics.write_atomic(self.metrics_file,recorder.textfile(summary,last_created))
+    except (IOError,OSError) as e:
+      log.warn("Unable to write run metrics [{0}]".format(e))
+
+  @staticmethod
+  def _held_instance(bstate,archive_name):
+    """ The instance called *archive_name* if an interval of *bstate* holds it """
+    if archive_name is None:
+      return None
+    for interval in bstate.intervals():
+      for instance in bstate[interval]:
+        if str(instance) == archive_name:
+          return instance
+    return None
+
+  def _reuse_instance(self,backup_name,bstate,instance,create):
+    """
+    Let the unchanged *instance* stand in for what *create* would have
+    made. Returns the (interval, instance) pairs that retires.
+    """
+    due = [create.interval] + create.tags
+    log.info("Nothing changed in '{0}' since {1}. Keeping it for {2}".format(
+                backup_name,instance,", ".join(due)))
+    now = datetime.datetime.now().replace(microsecond=0)
+    retire = []
+    with state.lock:
+      for interval in due:
+        if str(instance) not in set(str(held) for held in bstate.tier(interval)):
+          bstate.tag_instance(instance,interval)
+          # Only a tier that gained an instance has one too many now.
+          retire.extend(pair for pair in create.retire if pair[0] == interval)
+        self.changes.mark_checked(backup_name,interval,now)
+    return retire
 
+  @config_required
+  def run_daemon(self,*args,**kwargs):
+    from daemon import Daemon
+    return Daemon(self,kwargs['args']).run()
+
+  def reschedule(self,backup_name):
+    """ Work out again when the intervals of *backup_name* next fall due """
+    configured = intervals.configured(self.config.targets()[backup_name])
+    bstate = self.state.get(backup_name)
+    checked = self.checked(backup_name)
+    dues = dict((interval.name,interval.next_due(planner.latest_created(bstate,interval,checked)))
+                for interval in configured)
+    self.due_index.update(backup_name,intervals.signature(configured),dues)
+
+  def reconcile_schedule(self):
+    """
+    Bring the due index in line with the configuration. Only archives
+    that are new, or whose intervals changed, are worked out again.
+    """
+    index = self.due_index
+    targets = self.config.targets()
+    for name,bconfig in targets.iteritems():
+      if index.signature(name) != intervals.signature(intervals.configured(bconfig)):
+        self.reschedule(name)
+    for name in set(index.backups()) - set(targets):
+      index.forget(name)
+    self.store.flush_schedule(index)
+
+    # Fingerprints of archives that are gone, or no longer skip
+    # unchanged archives, would only go stale.
+    if self._changes is not None or os.path.exists(self.CHANGE_INDEX):
+      with state.lock:
+        for name in list(self.changes.entries):
+          if not targets.get(name,{}).get('skip_unchanged',False):
+            self.changes.forget(name)
+        self.changes.save()
+    return index
 
-  def try_backup(self,bservice, bconfig,bstate,interval):
-    """ Attempt to perform a backup at interval. Fail if you shouldn't """
+  @config_required
+  def reconcile_inventory(self,*args,**kwargs):
+    """
+    Adopt archives the services hold that the state lost track of, and
+    forget the ones they no longer hold.
+    """
+    cm_args = kwargs['args']
+    cache = InventoryCache.Load(self._userpath(self.INVENTORY_CACHE))
+    pending = set(entry['archive'] for entry in self.deletions.entries)
+
+    by_service = {}
+    for key,bconfig in self.config.targets().iteritems():
+      by_service.setdefault(bconfig['service'],{})[key] = bconfig['archive']
+
+    okay = True
+    touched = set()
+    for service_name,backups in sorted(by_service.iteritems()):
+      bservice = self.services[service_name]
+      if not bservice.list:
+        log.warn("Service '{0}' has no cmd_list. Skipping its {1} archives".format(
+                    service_name,len(backups)))
+        continue
+      try:
+        archives,fetched = inventory.fetch(bservice,cache,cm_args.max_age,cm_args.refresh)
+      except runner.CommandError as e:
+        log.error("Unable to list the archives of '{0}' [{1}]".format(service_name,e))
+        okay = False
+        continue
+
+      adopt,forget,foreign = inventory.diff(self.state,backups,archives,fetched,pending)
+      log.info("'{0}' holds {1} archives: {2} to adopt, {3} to forget, {4} not ours".format(
+                  service_name,len(archives),len(adopt),len(forget),foreign))
+      for backup,instance in adopt:
+        print("+ {0}".format(instance))
+      for backup,interval,instance in forget:
+        print("- {0} ({1})".format(instance,interval))
+      if cm_args.dry_run:
+        continue
+
+      with state.lock:
+        for backup,instance in adopt:
+          if backup not in self.state:
+            self.state[backup] = self.store.create(backup)
+          self.state[backup].adopt_instance(instance)
+          touched.add(backup)
+
+        gone = {}
+        for backup,interval,instance in forget:
+          gone.setdefault((backup,interval),[]).append(instance)
+        for (backup,interval),instances in gone.iteritems():
+          self.state[backup].remove_instances(interval,instances)
+          touched.add(backup)
+
+    cache.save()
+    if touched:
+      for backup in touched:
+        self.reschedule(backup)
+      self.store.flush(self.state)
+      self.store.flush_schedule(self.due_index)
+    return okay
 
-    latest_key = "last_{0}".format(interval)
+  def invalidate_inventory(self,backups):
+    """
+    Drop the cached archive lists of the services *backups* use, since
+    running them may have created or deleted archives.
+    """
+    path = self._userpath(self.INVENTORY_CACHE)
+    if not os.path.exists(path):
+      return
+    targets = self.config.targets()
+    cache = InventoryCache.Load(path)
+    cache.invalidate(set(targets[backup]['service']
+                         for backup in backups if backup in targets))
+    cache.save()
+
+  def write_profile(self):
+    """ Write the reports of a profiled run into self.profile_dir """
+    profiler = profiling.stop()
+    if profiler is None:
+      return
     try:
-      latest_created = bstate[latest_key].date_created
-    except KeyError:
-      latest_created = datetime.date(year=1900,month=1,day=1)
-
-    if (datetime.date.today() - latest_created) >= self.TIMEDELTAS[interval]:
-      if len(bstate[interval]) > bconfig[interval]:
-        okay = bservice.trim(interval,bstate)
-      elif len(bstate[interval]) == bconfig[interval]:
-        okay = bservice.rotate(interval,bstate,bconfig['files'])
-      else:
-        okay = bservice.add(interval,bstate,bconfig['files'])
+      written = profiler.write(self.profile_dir)
+    except (IOError,OSError) as e:
+      log.warn("Unable to write the profile [{0}]".format(e))
     else:
-      okay = True
-      log.info("Skipping '{0}' interval. It's only been {1}".format(
-                  interval,
-                  datetime.date.today() - latest_created))
+      log.info("Wrote {0} profile reports to '{1}'".format(len(written),self.profile_dir))
 
-    return okay
+  def stagger(self,backup_name,start,window):
+    """
+    Sleep until this host's slot for *backup_name* in the *window*
+    seconds after *start*.
+    """
+    delay = start + util.stagger_offset(backup_name,window) - time.time()
+    if delay > 0:
+      log.info("Staggering '{0}' by {1:.0f}s".format(backup_name,delay))
+      time.sleep(delay)
 
   def _setup_datadir(self):
     """
@@ -135,7 +589,11 @@ class Centrifuge(object):
       except OSError,e:
         raise CentrifugeFatalError("Unable to create data directory: {0}".format(e[1]))
 
-    self.state = state.State.ParseFile(self.STATEFILE)
+    import statestore
+    with metrics.phase("state_load"):
+      self._store = statestore.open_store(self.STATEFILE,self.STATE_DB)
+      self._state = self._store.load()
+      self._deletions = DeletionQueue.Load(self.DELETION_QUEUE)
 
   def _load_user_vars(self,location):
     """
@@ -161,22 +619,26 @@ class Centrifuge(object):
     """
     services = {}
 
-    for service_name,service_file in self.DEFAULT_SERVICES:
+    for service_name,service_file in self.default_services():
       try:
         services.update(service.BackupService.LoadSpecs(service_file,uservars))
       except service.ServiceDefinitionError,e:
         log.error("Error parsing built-in service '{0}': {1}".format(service_name,e))
 
+    cache = ServiceRegistryCache.Load(self._userpath(self.SERVICE_CACHE),uservars)
+    compile_spec = lambda path: service.BackupService.LoadSpecs(path,uservars)
+
     for addl_dir in additional_dirs:
-      for service_file in os.listdir(addl_dir):
+      for service_file in sorted(os.listdir(addl_dir)):
         fname = addl_dir + "/" + service_file
         try:
-          services.update(service.BackupService.LoadSpecs(fname,uservars))
+          services.update(cache.lookup(fname,compile_spec))
         except service.ServiceDefinitionError,e:
           log.error("Error parsing user service '{0}': {1}".format(fname,e))
         except service.ServiceLoadError,e:
-          pass
+          log.debug("Skipping '{0}': {1}".format(fname,e))
 
+    cache.save()
     return services
 
   @config_required
@@ -190,19 +652,21 @@ class Centrifuge(object):
       print("="*len(config[0]))
       print(BackupConfig.prettyprint(config[1]))
       print("")
+    return True
 
   def list_services(self,**kwargs):
     """
     List the available backup services we have
     """
     self.supported_services(printout=True)
+    return True
 
   def act(self):
     import argparse
     container = argparse.ArgumentParser(add_help=False)
     p = argparse.ArgumentParser(add_help=False)
     p.add_argument("-c","--config",type=str,
-                   help="Backup Configuration File",
+                   help="Backup configuration file, or a directory of configuration files",
                    required=True)
     p.add_argument("--uservars",
                    help="User variable specification file (Default ~/.centrifuge/user.vars)",
@@ -210,39 +674,78 @@ class Centrifuge(object):
     vbose = argparse.ArgumentParser(add_help=False)
     vbose.add_argument("-v",action="store_true",
                    help="Be verbose")
+    prof = argparse.ArgumentParser(add_help=False)
+    profg = prof.add_argument_group("profiling")
+    profg.add_argument("--profile",action="store_true",
+                   help="Profile each phase of the run with cProfile")
+    profg.add_argument("--trace-alloc",action="store_true",
+                   help="Trace what each phase of the run allocates with tracemalloc")
+    profg.add_argument("--profile-top",type=int,default=25,metavar="N",
+                   help="How many functions and lines the reports list (Default 25)")
 
     subp = container.add_subparsers(description="Commands")
-    runp = subp.add_parser("run",parents=[p,vbose],
+    runp = subp.add_parser("run",parents=[p,vbose,prof],
                            help="Run configured backups")
-    runp.add_argument("backup_name",nargs="+")
-    runp.set_defaults(func=self.run_backups)
+    runp.add_argument("-j","--jobs",type=int,default=1,
+                      help="Number of archives to run at the same time (Default 1)")
+    runp.add_argument("--stagger",type=util.parse_duration,metavar="WINDOW",
+                      help="Spread archive start times over WINDOW (e.g. 30m) using "
+                           "a stable per-host, per-archive delay")
+    runp.add_argument("--all",action="store_true",
+                      help="Run every configured archive that is due")
+    runp.add_argument("-n","--dry-run",action="store_true",
+                      help="Print what the run would create and delete as JSON, and stop")
+    runp.add_argument("--metrics-file",metavar="PATH",
+                      help="Also write the run's metrics to PATH for node_exporter's "
+                           "textfile collector")
+    runp.add_argument("backup_name",nargs="*")
+    runp.set_defaults(func=self.run_backups,needs_services=True)
+
+    daemonp = subp.add_parser("daemon",parents=[p,vbose,prof],
+                              help="Stay running and back up archives as they fall due")
+    daemonp.add_argument("-j","--jobs",type=int,default=1,
+                         help="Number of archives to run at the same time (Default 1)")
+    daemonp.add_argument("--metrics-file",metavar="PATH",
+                         help="Also write each run's metrics to PATH for node_exporter's "
+                              "textfile collector")
+    daemonp.set_defaults(func=self.run_daemon,needs_services=True)
 
     lsp = subp.add_parser("list_services",parents=[vbose],
                           help="List the available backup services")
-    lsp.set_defaults(func=self.list_services)
+    lsp.set_defaults(func=self.list_services,needs_services=True)
 
     lsb = subp.add_parser("list_backups",parents=[p],
                           help="List the configured backups")
-    lsb.set_defaults(func=self.list_backups)
+    lsb.set_defaults(func=self.list_backups,needs_services=True)
 
-    state.State.make_parser(self.state,subp,parents=[vbose])
+    state.State.make_parser(None,subp,parents=[vbose])
 
     args = container.parse_args()
     self.config_file = getattr(args,"config",None)
+    self.metrics_file = getattr(args,"metrics_file",None)
 
-    user_spec_vars = self._load_user_vars(args.uservars)
-    # Look for services in our additional locations.
-    addl_svc_dir = filter( os.path.exists, self.ADDL_SERVICE_DIRS)
-    self.services = self._load_services(user_spec_vars,addl_svc_dir)
-
-    if args.v:
+    if getattr(args,"v",False):
       log.setLevel(logging.DEBUG)
 
+    if getattr(args,"profile",False) or getattr(args,"trace_alloc",False):
+      profiling.start(args.profile,args.trace_alloc,args.profile_top)
+      self.profile_dir = os.path.join(os.path.dirname(self.RUN_SUMMARY),"profiles",
+                                      time.strftime(state.TIMESTAMP_FORMAT))
+
     try:
-      return args.func(args=args,state=self.state)
-    except ServiceNotAvailableError, e:
+      # Services are only loaded for the commands that use them; the
+      # state commands and --help shouldn't pay for parsing every spec.
+      if getattr(args,"needs_services",False) or getattr(args,"reconcile",False):
+        self.services = self.load_services(getattr(args,"uservars","~/.centrifuge/user.vars"))
+
+      if getattr(args,"needs_state",False):
+        return args.func(args=args,state=self.state,store=self.store,centrifuge=self)
+      return args.func(args=args)
+    except (ServiceNotAvailableError,InvalidConfigurationError), e:
       log.error(e)
-      return -1;
+      return False
+    finally:
+      self.write_profile()
 
 
 
@@ -255,6 +758,7 @@ def run():
       sys.exit(1)
   except CentrifugeFatalError,e:
     log.error("{0}".format(e))
+    sys.exit(1)
 
 if __name__ == 'main':
   run()
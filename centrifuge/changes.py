@@ -0,0 +1,194 @@
+"""
+Notice when an archive's files haven't changed.
+
+An archive with ``skip_unchanged: true`` has its files fingerprinted
+before each create: every file and directory under its paths, by path,
+size, mtime, inode and mode, hashed into one digest per configured
+path. Files the archive excludes are left out, and the patterns
+themselves are part of the digest. If the fingerprint matches the one
+taken for the archive's latest instance, there is nothing new to back
+up. That instance is tagged into the due intervals instead of creating
+another archive.
+
+Paths are walked with scandir (os.scandir, or the scandir backport on
+Python 2), which gets most of what we need from the directory listing
+itself, and fall back to listdir and lstat without it. Each configured
+path is walked on a worker of its own.
+
+The ChangeIndex keeps, per archive, the fingerprint, the instance it
+belongs to, and when each interval was last found unchanged, which
+counts as a backup when working out when the interval is next due.
+"""
+import os
+import stat
+import hashlib
+import cPickle
+import logging
+
+from executor import WorkerPool
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+log = logging.getLogger("centrifuge.changes")
+
+__ALL__ = [ "ChangeIndex",
+            "fingerprint"
+          ]
+
+# How many configured paths of one archive are walked at once.
+SCAN_JOBS = 4
+
+class ChangeIndex(object):
+
+  VERSION = 1
+
+  def __init__(self,path,entries=None):
+    self.path = path
+    # backup -> {'fingerprint', 'archive', 'checked': {interval: datetime}}
+    self.entries = entries if entries else {}
+    self._dirty = False
+
+  @classmethod
+  def Load(cls,path):
+    """ Load the index stored at *path*. A missing or unreadable index is empty. """
+    try:
+      with open(path,'rb') as indexfile:
+        stored = cPickle.load(indexfile)
+    except IOError:
+      return cls(path)
+    except Exception as e:
+      log.warn("Ignoring unreadable change index '{0}' [{1}]".format(path,e))
+      return cls(path)
+
+    if stored.get('version') != cls.VERSION:
+      return cls(path)
+    return cls(path,stored['entries'])
+
+  def unchanged(self,backup,current):
+    """
+    The name of the instance *backup*'s files looked like *current*
+    for, if that is still how they look. None otherwise.
+    """
+    entry = self.entries.get(backup)
+    if entry and entry['fingerprint'] == current:
+      return entry['archive']
+    return None
+
+  def record(self,backup,current,archive):
+    """ *backup*'s files looked like *current* when *archive* was created """
+    self.entries[backup] = {'fingerprint': current,'archive': str(archive),'checked': {}}
+    self._dirty = True
+
+  def checked(self,backup):
+    """ When each interval of *backup* was last found unchanged """
+    entry = self.entries.get(backup)
+    return entry['checked'] if entry else {}
+
+  def mark_checked(self,backup,interval,when):
+    self.entries[backup]['checked'][interval] = when
+    self._dirty = True
+
+  def forget(self,backup):
+    """ Drop everything known about *backup* """
+    if self.entries.pop(backup,None) is not None:
+      self._dirty = True
+
+  def save(self):
+    """ Write the index back out, if anything changed """
+    if not self._dirty:
+      return
+    try:
+      tmppath = self.path + ".tmp"
+      with open(tmppath,'wb') as indexfile:
+        cPickle.dump({'version': self.VERSION,'entries': self.entries},
+                     indexfile,cPickle.HIGHEST_PROTOCOL)
+      os.rename(tmppath,self.path)
+    except (IOError,OSError) as e:
+      log.warn("Unable to write change index '{0}' [{1}]".format(self.path,e))
+    else:
+      self._dirty = False
+
+def fingerprint(paths,jobs=SCAN_JOBS,excludes=None):
+  """
+  A fingerprint of everything under *paths*, less what *excludes* (an
+  excludes.Excludes) matches: a dict of each path to the digest of its
+  tree.
+  """
+  digests = WorkerPool(jobs).map(lambda top: _digest(top,excludes),paths)
+  return dict(zip(paths,digests))
+
+def _digest(top,excludes=None):
+  digest = hashlib.sha1()
+  walk = _walk_scandir if scandir is not None else _walk_listdir
+  if excludes:
+    # So changing what is excluded counts as a change.
+    digest.update("exclude {0!r}\n".format(excludes.patterns))
+    if excludes.excluded(top):
+      return digest.hexdigest()
+  try:
+    info = os.lstat(top)
+  except OSError as e:
+    digest.update("missing {0}\n".format(e.errno))
+    return digest.hexdigest()
+
+  digest.update(_line(top,info.st_size,info.st_mtime,info.st_ino,info.st_mode))
+  if stat.S_ISDIR(info.st_mode):
+    walk(top,digest,excludes)
+  return digest.hexdigest()
+
+def _line(path,size,mtime,inode,mode):
+  return "{0}\0{1}\0{2!r}\0{3}\0{4}\n".format(path,size,mtime,inode,mode)
+
+def _unreadable(path,e,digest):
+  # Part of the fingerprint, so it stays stable while the error does.
+  log.debug("Can't read '{0}' [{1}]".format(path,e))
+  digest.update("{0}\0error {1}\n".format(path,e.errno))
+
+def _walk_scandir(top,digest,excludes):
+  pending = [top]
+  while pending:
+    directory = pending.pop()
+    try:
+      entries = sorted(scandir(directory),key=lambda entry: entry.name)
+    except OSError as e:
+      _unreadable(directory,e,digest)
+      continue
+    for entry in entries:
+      if excludes and excludes.excluded(entry.path):
+        continue
+      try:
+        info = entry.stat(follow_symlinks=False)
+      except OSError as e:
+        _unreadable(entry.path,e,digest)
+        continue
+      digest.update(_line(entry.path,info.st_size,info.st_mtime,entry.inode(),info.st_mode))
+      if stat.S_ISDIR(info.st_mode):
+        pending.append(entry.path)
+
+def _walk_listdir(top,digest,excludes):
+  pending = [top]
+  while pending:
+    directory = pending.pop()
+    try:
+      names = sorted(os.listdir(directory))
+    except OSError as e:
+      _unreadable(directory,e,digest)
+      continue
+    for name in names:
+      path = os.path.join(directory,name)
+      if excludes and excludes.excluded(path):
+        continue
+      try:
+        info = os.lstat(path)
+      except OSError as e:
+        _unreadable(path,e,digest)
+        continue
+      digest.update(_line(path,info.st_size,info.st_mtime,info.st_ino,info.st_mode))
+      if stat.S_ISDIR(info.st_mode):
+        pending.append(path)
@@ -1,8 +1,20 @@
+import os
 import yaml
+import fnmatch
+import hashlib
 import logging
-import pkg_resources
 log = logging.getLogger('centrifuge.config')
 
+import excludes
+import intervals
+
+# libyaml's loader is several times faster on large configurations.
+SafeLoader = getattr(yaml,'CSafeLoader',yaml.SafeLoader)
+
+# Joins an archive's name and a service into the state key of each of
+# the archive's secondary targets.
+TARGET_SEPARATOR = "@"
+
 class InvalidConfigurationError(Exception):
   pass
 
@@ -16,34 +28,143 @@ class ServiceNotAvailableError(Exception):
 
 class BackupConfig(dict):
 
-  RX_SCHEMA = pkg_resources.resource_string(__name__,"data/config_schema.rx")
+  _rx_schema = None
+  _checker = None
+
+  # Which files in a configuration directory are read.
+  FRAGMENT_PATTERNS = ("*.yaml","*.yml","*.conf","*.config")
+
+  @classmethod
+  def rx_schema(cls):
+    """ The Rx schema configurations are checked against, read on first use """
+    if cls._rx_schema is None:
+      import pkg_resources
+      cls._rx_schema = pkg_resources.resource_string(__name__,"data/config_schema.rx")
+    return cls._rx_schema
+
+  @classmethod
+  def checker(cls):
+    """
+    The compiled config schema. Compiled once per process and shared
+    by every validation.
+    """
+    if cls._checker is None:
+      import schema
+      cls._checker = schema.compile_schema(yaml.safe_load(cls.rx_schema()),key=cls.rx_schema())
+    return cls._checker
 
   @staticmethod
   def validate(configobj):
-    import rx.Rx as rx
-    rx_validator = rx.Factory(
-                        { "register_core_types": True}
-                    ).make_schema(
-                          yaml.safe_load(BackupConfig.RX_SCHEMA)
-                      )
-    valid = []
+    """
+    Check every archive in *configobj* against the schema. Returns a
+    list of problems as "archive.field: message" strings, which is
+    empty if the whole configuration is valid.
+    """
+    if not isinstance(configobj,dict):
+      return ["<top>: expected a mapping of archive names to archives"]
+
+    checker = BackupConfig.checker()
+    errors = []
     for name,config in configobj.iteritems():
-      if not rx_validator.check(config):
-        log.warn("Failed to validate '{0}'".format(name))
-        valid.append(False)
+      if not checker.check(config):
+        archive_errors = checker.errors(config,path=str(name))
       else:
-        valid.append(True)
+        # The schema can't say what a valid duration or expression looks like.
+        archive_errors = (intervals.check(str(name),config) +
+                          excludes.check(str(name),config) +
+                          BackupConfig._check_services(str(name),config))
+      if archive_errors:
+        log.warn("Failed to validate '{0}'".format(name))
+        errors.extend(archive_errors)
 
-    return valid
+    return errors
 
-  def __init__(self,configfile):
-    config = yaml.safe_load(open(configfile))
-    validated = BackupConfig.validate(config)
-    if all(validated):
-      self.update(config)
-    else:
-      raise InvalidConfigurationError("{0}".format(
-                  [c for i,c in enumerate(config) if not validated[i]]))
+  @staticmethod
+  def _check_services(name,bconfig):
+    services = BackupConfig.services_of(bconfig)
+    if len(set(services)) != len(services):
+      return ["{0}.service: lists a service more than once".format(name)]
+    return []
+
+  @staticmethod
+  def services_of(bconfig):
+    """ The services an archive is backed up to, primary first """
+    service = bconfig['service']
+    return list(service) if isinstance(service,list) else [service]
+
+  @staticmethod
+  def target_key(name,service,primary=False):
+    """
+    The key of the state, schedule and metrics of archive *name*'s
+    copy on *service*. The primary copy is keyed by the archive's own
+    name, so adding a service to an archive leaves its history alone.
+    """
+    if primary:
+      return name
+    return "{0}{1}{2}".format(name,TARGET_SEPARATOR,service)
+
+  def __init__(self,configpath,cache_path=None):
+    """
+    Load the configuration at *configpath*, which is either a single
+    file or a directory of configuration fragments.
+
+    If *cache_path* is given, the parsed and validated contents of
+    each file are cached there, and only files that changed are
+    parsed again.
+    """
+    self.sources = {}
+    self._targets = {}
+    self._cache = None
+    if cache_path:
+      from filecache import FileCache
+      self._cache = FileCache.Load(cache_path,
+                                   salt=hashlib.sha1(self.rx_schema()).hexdigest(),
+                                   hash_contents=True)
+
+    for configfile in self.config_files(configpath):
+      self.add_config(configfile)
+
+    if self._cache:
+      self._cache.save()
+
+  @classmethod
+  def config_files(cls,configpath):
+    """ The configuration files *configpath* refers to, in load order """
+    if not os.path.isdir(configpath):
+      return [configpath]
+
+    return [os.path.join(configpath,fname)
+            for fname in sorted(os.listdir(configpath))
+            if not fname.startswith(".")
+            and any(fnmatch.fnmatch(fname,pattern) for pattern in cls.FRAGMENT_PATTERNS)]
+
+  @staticmethod
+  def parse(configfile):
+    """ Load and validate *configfile*, returning its archives """
+    with open(configfile) as conf:
+      config = yaml.load(conf,Loader=SafeLoader)
+    if config is None:
+      log.debug("'{0}' is empty".format(configfile))
+      return {}
+
+    errors = BackupConfig.validate(config)
+    if errors:
+      raise InvalidConfigurationError("{0}: {1}".format(configfile,"; ".join(errors)))
+    return config
+
+  def targets(self):
+    """
+    Every archive's copy on each of its services, as a dict of target
+    keys (see target_key) to that archive's configuration with
+    *service* set to the one service, and *archive* to its name.
+    """
+    return self._targets
+
+  def targets_of(self,name):
+    """ The target keys of archive *name*, primary first """
+    bconfig = self[name]
+    return [self.target_key(name,service,n == 0)
+            for n,service in enumerate(self.services_of(bconfig))]
 
   @staticmethod
   def prettyprint(conf):
@@ -57,12 +178,14 @@ Files:
 """
 
     pp = template.format(
-            service = conf['service'],
+            service = ", ".join(BackupConfig.services_of(conf)),
             files = "\n\t".join(conf['files']),
             monthly= conf['monthly'] if 'monthly' in conf else "0",
             weekly=conf['weekly'] if 'weekly' in conf else "0",
             daily=conf['daily'] if 'daily' in conf else "0"
           )
+    for name,spec in sorted(conf.get('intervals',{}).iteritems()):
+      pp += "# {0}: {1} (every {2})\n".format(name.capitalize(),spec['keep'],spec['every'])
     return pp
 
   def iterconfig(self):
@@ -71,13 +194,46 @@ Files:
 
 
   def add_config(self,configfile):
-    config = yaml.safe_load(open(configfile))
-    validated = BackupConfig.validate(config)
-    if all(validated):
-      self.update(config)
+    """
+    Add the archives in *configfile*. An archive name may only be
+    defined once across all files.
+    """
+    if self._cache:
+      config = self._cache.lookup(configfile,BackupConfig.parse)
     else:
-      raise InvalidConfigurationError("{0}".format(
-                  [c for i,c in enumerate(config) if not validated[i]]))
+      config = BackupConfig.parse(configfile)
+
+    for name in config:
+      if name in self.sources:
+        raise InvalidConfigurationError(
+            "Archive '{0}' is defined in both '{1}' and '{2}'".format(
+                name,self.sources[name],configfile))
+      self.sources[name] = configfile
+
+    self.update(config)
+    self._add_targets(config)
+
+  def _add_targets(self,config):
+    """
+    Add the targets of the archives in *config*, which were just added.
+    A secondary target's key can't also be an archive's name, or the
+    two would share a state.
+    """
+    for name in config:
+      if name in self._targets:
+        target = self._targets[name]
+        raise InvalidConfigurationError(
+            "Archive '{0}' on '{1}' would share its state with the archive '{2}'".format(
+                target['archive'],target['service'],name))
+
+    for name,bconfig in config.iteritems():
+      for n,service in enumerate(self.services_of(bconfig)):
+        key = self.target_key(name,service,n == 0)
+        if n > 0 and key in self:
+          raise InvalidConfigurationError(
+              "Archive '{0}' on '{1}' would share its state with the archive '{2}'".format(
+                  name,service,key))
+        self._targets[key] = dict(bconfig,service=service,archive=name)
 
   def check_services(self,available):
     """
@@ -85,5 +241,6 @@ Files:
     with the services in `available`.
     """
     for name,config in self.iterconfig():
-      if config['service'] not in available:
-        raise ServiceNotAvailableError(config['service'])
+      for service in self.services_of(config):
+        if service not in available:
+          raise ServiceNotAvailableError(service)
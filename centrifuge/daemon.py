@@ -0,0 +1,116 @@
+"""
+Run Centrifuge as a long-lived process.
+
+The daemon keeps the configuration, services and state loaded, sleeps
+until the next archive falls due according to the due index, and runs
+the due archives through a bounded WorkerPool. SIGHUP reloads the
+configuration and service definitions. SIGTERM and SIGINT stop the
+daemon once the archives that are already running have finished.
+"""
+import time
+import signal
+import logging
+import datetime
+
+import metrics
+from executor import WorkerPool
+
+log = logging.getLogger("centrifuge.daemon")
+
+class Daemon(object):
+
+  # Never sleep longer than this, so clock changes and edits to the
+  # state made behind our back are noticed eventually.
+  MAX_SLEEP = 300
+  # How long an archive that failed waits before it is tried again.
+  RETRY_DELAY = datetime.timedelta(minutes=15)
+
+  def __init__(self,centrifuge,args):
+    self.centrifuge = centrifuge
+    self.args = args
+    self.pool = WorkerPool(getattr(args,"jobs",1))
+    self.retry_at = {}
+    self._stop = False
+    self._reload = False
+
+  def run(self):
+    signal.signal(signal.SIGHUP,self._on_hup)
+    signal.signal(signal.SIGTERM,self._on_stop)
+    signal.signal(signal.SIGINT,self._on_stop)
+    log.info("Daemon started with {0} archives".format(len(self.centrifuge.config)))
+    self.centrifuge.reconcile_schedule()
+
+    while not self._stop:
+      if self._reload:
+        self.reload()
+
+      due,wake = self.schedule(datetime.datetime.now())
+      if due:
+        self.run_due(due)
+      else:
+        self.sleep_until(wake)
+
+    log.info("Daemon stopped")
+    return True
+
+  def schedule(self,now):
+    """
+    Return the archives that are due at *now*, and when the next one
+    that isn't falls due.
+    """
+    ready = []
+    due,wake = self.centrifuge.due_index.due(now)
+    for name in due:
+      retry = self.retry_at.get(name)
+      if retry is not None and retry > now:
+        wake = retry if wake is None else min(wake,retry)
+      else:
+        ready.append(name)
+    return ready,wake
+
+  def run_due(self,due):
+    log.info("Running {0} due archives".format(len(due)))
+    metrics.reset()
+    plan = self.centrifuge.plan(due,datetime.datetime.now().replace(microsecond=0))
+    results = self.centrifuge.apply_plan(plan,self.pool)
+
+    now = datetime.datetime.now()
+    for name in due:
+      if results.get(name,True):
+        self.retry_at.pop(name,None)
+      else:
+        log.warn("'{0}' failed. Retrying after {1}".format(name,self.RETRY_DELAY))
+        self.retry_at[name] = now + self.RETRY_DELAY
+
+  def sleep_until(self,wake):
+    """ Sleep until *wake* or a signal arrives, whichever is first """
+    seconds = self.MAX_SLEEP
+    if wake is not None:
+      seconds = min(seconds,(wake - datetime.datetime.now()).total_seconds())
+    if seconds > 0:
+      log.debug("Sleeping {0:.0f}s".format(seconds))
+      # A signal interrupts the sleep, and the handlers just set flags.
+      time.sleep(seconds)
+
+  def reload(self):
+    """ Reload the configuration and services, keeping the old ones on error """
+    self._reload = False
+    log.info("Reloading configuration and services")
+    cf = self.centrifuge
+    old_services = cf.services
+    try:
+      cf.services = cf.load_services(getattr(self.args,"uservars","~/.centrifuge/user.vars"))
+      cf.config = cf.load_config()
+    except Exception as e:
+      cf.services = old_services
+      log.error("Reload failed, keeping the previous configuration [{0}]".format(e))
+    else:
+      self.retry_at.clear()
+      cf.reconcile_schedule()
+
+  def _on_hup(self,signum,frame):
+    self._reload = True
+
+  def _on_stop(self,signum,frame):
+    log.info("Stopping once running archives have finished")
+    self._stop = True
@@ -1,4 +1,12 @@
 tarsnap:
   var_bin: "/usr/local/bin/tarsnap"
-  cmd_create: "$var_bin $user_config --print-stats --humanize-numbers --one-file-system -cf $archive_name"
-  cmd_delete: "$var_bin $user_config -df $archive_name"   
+  files: list
+  exclude: "--exclude $pattern"
+  cmd_create: "$var_bin $user_config --print-stats --humanize-numbers --one-file-system --null -T $file_list -cf $archive_name"
+  cmd_delete: "$var_bin $user_config -df $archive_name"
+  cmd_delete_batch: "$var_bin $user_config -d [-f $archive_name]"
+  cmd_list: "$var_bin $user_config --list-archives"
+  stats:
+    size: '^This archive\s+([\d.]+(?: \S*B)?)'
+    compressed: '^This archive\s+[\d.]+(?: \S*B)?\s+([\d.]+(?: \S*B)?)'
+    new: '^New data\s+[\d.]+(?: \S*B)?\s+([\d.]+(?: \S*B)?)'
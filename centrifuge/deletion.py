@@ -0,0 +1,121 @@
+"""
+A persistent queue of archives waiting to be deleted.
+
+A run creates its new archives first and queues the ones they retire
+here instead of deleting them on the spot. The queue is drained once
+the creates are finished, in one batch per service across every
+archive; anything that fails to delete stays in the queue file and is
+retried by the next run.
+"""
+import os
+import time
+import yaml
+import logging
+import threading
+
+log = logging.getLogger("centrifuge.deletion")
+
+class DeletionQueue(object):
+
+  MAX_ATTEMPTS = 5
+
+  def __init__(self,path,entries=None):
+    self.path = path
+    self.entries = entries if entries else []
+    self._lock = threading.RLock()
+
+  @classmethod
+  def Load(cls,path):
+    """ Load the queue stored at *path*. A missing file is an empty queue. """
+    try:
+      with open(path) as queuefile:
+        entries = yaml.safe_load(queuefile)
+    except IOError:
+      log.debug("Deletion queue '{0}' doesn't exist. Will create".format(path))
+      entries = None
+    except yaml.YAMLError as e:
+      log.error("Unable to parse deletion queue '{0}'. Ignoring it [{1}]".format(path,e))
+      entries = None
+
+    return cls(path,entries)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def push(self,service_name,archive):
+    """ Queue *archive* for deletion from the service *service_name* """
+    self.push_many(service_name,[archive])
+
+  def push_many(self,service_name,archives):
+    """
+    Queue every archive in *archives* for deletion from the service
+    *service_name*, writing the queue out once.
+    """
+    queued = int(time.time())
+    with self._lock:
+      for archive in archives:
+        self.entries.append({
+            'service': service_name,
+            'archive': str(archive),
+            'queued': queued,
+            'attempts': 0
+          })
+      self.save()
+    for archive in archives:
+      log.info("Queued {0} for deletion".format(archive))
+
+  def save(self):
+    """ Write the queue out, replacing the old file atomically """
+    with self._lock:
+      tmppath = self.path + ".tmp"
+      with open(tmppath,'w') as queuefile:
+        yaml.safe_dump(self.entries,queuefile,default_flow_style=False)
+      os.rename(tmppath,self.path)
+
+  def drain(self,services):
+    """
+    Try to delete everything in the queue, batching deletes per
+    service. Entries that fail are kept for the next drain until they
+    have failed MAX_ATTEMPTS times.
+
+    Returns True if the queue was emptied.
+    """
+    with self._lock:
+      if not self.entries:
+        return True
+
+      by_service = {}
+      for entry in self.entries:
+        by_service.setdefault(entry['service'],[]).append(entry)
+
+      remaining = []
+      for service_name,entries in by_service.iteritems():
+        try:
+          bservice = services[service_name]
+        except KeyError:
+          log.warn("Can't delete {0} archives from unknown service '{1}'".format(
+                      len(entries),service_name))
+          remaining.extend(entries)
+          continue
+
+        pending = dict((entry['archive'],entry) for entry in entries)
+        for archives,error in bservice.delete_archives(sorted(pending)):
+          for archive in archives:
+            entry = pending.pop(archive)
+            if not error:
+              log.info("Deleted queued archive {0}".format(archive))
+              continue
+
+            entry['attempts'] += 1
+            entry['error'] = str(error)
+            if entry['attempts'] >= self.MAX_ATTEMPTS:
+              log.error("Giving up on deleting {0} after {1} attempts [{2}]".format(
+                          archive,entry['attempts'],error))
+            else:
+              log.warn("Failed to delete queued archive {0}. Will retry [{1}]".format(
+                          archive,error))
+              remaining.append(entry)
+
+      self.entries = remaining
+      self.save()
+      return not remaining
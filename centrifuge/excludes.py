@@ -0,0 +1,185 @@
+"""
+Leave files out of an archive.
+
+An archive's *exclude* list holds patterns of files not to back up.
+A pattern is a shell glob unless it starts with ``re:``, in which case
+the rest of it is a regular expression:
+
+- A glob without a ``/`` matches the name of any file or directory at
+  any depth, like ``node_modules`` or ``*.qcow2``.
+- A glob with a ``/`` matches the whole path, like ``/home/*/.cache``.
+- A regular expression is searched for in the whole path.
+
+Excluding a directory excludes everything under it.
+
+Services that can exclude files themselves say how in their spec, and
+are handed the globs as arguments. For services that can't, and for
+regular expressions, Centrifuge walks the archive's paths and hands
+the service only what is left. Subtrees with nothing excluded in them
+are handed over whole. Only the directories on the way to something
+excluded are expanded into their entries, and those directories
+themselves can't be handed over, since the service would back up
+everything in them. Their own mode and owner are therefore not
+archived, and a restore recreates them with defaults.
+"""
+import os
+import re
+import stat
+import fnmatch
+import logging
+
+log = logging.getLogger("centrifuge.excludes")
+
+__ALL__ = [ "Excludes",
+            "compile",
+            "check"
+          ]
+
+REGEX_PREFIX = "re:"
+
+class Excludes(object):
+
+  def __init__(self,patterns):
+    self.patterns = tuple(patterns)
+    # Globs, as written, for services that exclude files themselves.
+    self.globs = []
+    self._names = []
+    self._paths = []
+    self.regexes = []
+    for pattern in self.patterns:
+      if pattern.startswith(REGEX_PREFIX):
+        self.regexes.append(re.compile(pattern[len(REGEX_PREFIX):]))
+        continue
+      self.globs.append(pattern)
+      matcher = re.compile(fnmatch.translate(pattern.rstrip("/")))
+      if "/" in pattern.rstrip("/"):
+        self._paths.append(matcher)
+      else:
+        self._names.append(matcher)
+
+  def __nonzero__(self):
+    return bool(self.patterns)
+
+  def excluded(self,path):
+    """ Whether *path* matches any of the patterns """
+    name = os.path.basename(path.rstrip("/")) or path
+    return (any(matcher.match(name) for matcher in self._names) or
+            any(matcher.match(path) for matcher in self._paths) or
+            any(regex.search(path) for regex in self.regexes))
+
+  def expand(self,paths):
+    """
+    Yield what is left of *paths* once everything excluded is taken
+    out: whole paths and subtrees where nothing under them is
+    excluded, and the other entries of the directories that lead to
+    something excluded, so that a service backing them all up
+    recurses into nothing excluded.
+    """
+    for top in paths:
+      if self.excluded(top):
+        log.debug("Excluding '{0}'".format(top))
+        continue
+      try:
+        info = os.lstat(top)
+      except OSError:
+        # Let the service complain about it.
+        yield top
+        continue
+      if not stat.S_ISDIR(info.st_mode):
+        yield top
+        continue
+      kept = self._walk(top)
+      if kept is None:
+        yield top
+      else:
+        for path in kept:
+          yield path
+
+  def _walk(self,top):
+    """
+    The entries to back up under the directory *top*, or None if
+    nothing under it is excluded and it can be backed up whole.
+    """
+    top = os.path.normpath(top)
+    touched = self._touched(top)
+    if not touched:
+      return None
+
+    # Only the directories leading to something excluded are listed
+    # again; everything else in them is handed over as it is.
+    kept = []
+    pending = [top]
+    while pending:
+      directory = pending.pop()
+      try:
+        names = sorted(os.listdir(directory))
+      except OSError as e:
+        log.warn("Can't read '{0}' to apply exclusions [{1}]".format(directory,e))
+        kept.append(directory)
+        continue
+      for name in names:
+        path = os.path.join(directory,name)
+        if path in touched:
+          pending.append(path)
+        elif not self.excluded(path):
+          kept.append(path)
+    return kept
+
+  def _touched(self,top):
+    """
+    The directories under *top* (and *top* itself) that something
+    excluded is somewhere under.
+    """
+    touched = set()
+    pending = [top]
+    while pending:
+      directory = pending.pop()
+      try:
+        names = os.listdir(directory)
+      except OSError as e:
+        log.warn("Can't read '{0}' to apply exclusions [{1}]".format(directory,e))
+        continue
+      for name in names:
+        path = os.path.join(directory,name)
+        if self.excluded(path):
+          log.debug("Excluding '{0}'".format(path))
+          parent = directory
+          while parent not in touched:
+            touched.add(parent)
+            if parent == top:
+              break
+            parent = os.path.dirname(parent)
+          continue
+        try:
+          if stat.S_ISDIR(os.lstat(path).st_mode):
+            pending.append(path)
+        except OSError:
+          pass
+    return touched
+
+_compiled = {}
+
+def compile(patterns):
+  """ The Excludes for *patterns*, compiled once per process """
+  key = tuple(patterns or ())
+  try:
+    return _compiled[key]
+  except KeyError:
+    excludes = _compiled[key] = Excludes(key)
+    return excludes
+
+def check(name,bconfig):
+  """
+  Problems with the exclude patterns of archive *name*, in the same
+  form BackupConfig.validate reports them.
+  """
+  errors = []
+  for n,pattern in enumerate(bconfig.get('exclude',[])):
+    if not pattern.startswith(REGEX_PREFIX):
+      continue
+    try:
+      re.compile(pattern[len(REGEX_PREFIX):])
+    except re.error as e:
+      errors.append("{0}.exclude[{1}]: invalid regular expression '{2}' [{3}]".format(
+                      name,n,pattern[len(REGEX_PREFIX):],e))
+  return errors
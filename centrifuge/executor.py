@@ -0,0 +1,66 @@
+"""
+A small bounded worker pool for running independent jobs at the same
+time. Centrifuge uses it to run several archives concurrently, since
+almost all of the time spent on a backup is spent waiting on the
+backup service.
+"""
+import Queue
+import logging
+import threading
+
+log = logging.getLogger("centrifuge.executor")
+
+class WorkerPool(object):
+  """
+  Run a callable over a list of items with at most *jobs* of them
+  in flight at once.
+  """
+
+  def __init__(self, jobs=1):
+    self.jobs = max(1, int(jobs))
+
+  def map(self, func, items):
+    """
+    Call *func* on every element of *items* and return the results
+    in the same order as *items*.
+
+    A job that raises is logged and reported as False, so one broken
+    archive can't take down the rest of the run.
+    """
+    items = list(items)
+    results = [None] * len(items)
+
+    if self.jobs == 1 or len(items) < 2:
+      for i, item in enumerate(items):
+        results[i] = self._call(func, item)
+      return results
+
+    pending = Queue.Queue()
+    for i, item in enumerate(items):
+      pending.put((i, item))
+
+    def _worker():
+      while True:
+        try:
+          i, item = pending.get_nowait()
+        except Queue.Empty:
+          return
+        results[i] = self._call(func, item)
+
+    workers = [threading.Thread(target=_worker, name="centrifuge-worker-{0}".format(n))
+               for n in range(min(self.jobs, len(items)))]
+    for worker in workers:
+      worker.daemon = True
+      worker.start()
+    for worker in workers:
+      worker.join()
+
+    return results
+
+  @staticmethod
+  def _call(func, item):
+    try:
+      return func(item)
+    except Exception as e:
+      log.exception("Job '{0}' failed: {1}".format(item, e))
+      return False
@@ -0,0 +1,109 @@
+"""
+A persistent cache of things compiled from files.
+
+Entries are keyed on a file's path, mtime and size. A cache can also
+hash file contents, so a file that was touched but not changed is
+still a hit. The cache as a whole carries a *salt*. When the salt
+changes, for example because the inputs the files were compiled with
+changed, every entry is thrown away.
+"""
+import os
+import cPickle
+import hashlib
+import logging
+
+log = logging.getLogger("centrifuge.filecache")
+
+class FileCache(object):
+
+  VERSION = 1
+
+  def __init__(self,path,salt="",hash_contents=False):
+    self.path = path
+    self.salt = salt
+    self.hash_contents = hash_contents
+    self.entries = {}
+    self._seen = set()
+    self._dirty = False
+
+  @classmethod
+  def Load(cls,path,*args,**kwargs):
+    """
+    Load the cache stored at *path*. A missing, unreadable or stale
+    cache is simply an empty one.
+    """
+    cache = cls(path,*args,**kwargs)
+    try:
+      with open(path,'rb') as cachefile:
+        stored = cPickle.load(cachefile)
+    except IOError:
+      log.debug("No cache at '{0}'".format(path))
+      return cache
+    except Exception as e:
+      log.debug("Ignoring unreadable cache '{0}' [{1}]".format(path,e))
+      return cache
+
+    if (stored.get('version') == cls.VERSION
+        and stored.get('salt') == cache.salt):
+      cache.entries = stored['entries']
+    else:
+      log.debug("Cache '{0}' is stale. Rebuilding".format(path))
+      cache._dirty = True
+    return cache
+
+  def lookup(self,filepath,compile_file):
+    """
+    Return what *compile_file(filepath)* returns, calling it only if
+    the file changed since it was cached.
+    """
+    info = os.stat(filepath)
+    key = (info.st_mtime,info.st_size)
+    self._seen.add(filepath)
+
+    entry = self.entries.get(filepath)
+    if entry and entry['key'] == key:
+      return entry['value']
+
+    digest = None
+    if self.hash_contents:
+      with open(filepath,'rb') as contents:
+        digest = hashlib.sha1(contents.read()).hexdigest()
+      if entry and entry.get('digest') == digest:
+        log.debug("'{0}' was touched but hasn't changed".format(filepath))
+        entry['key'] = key
+        self._dirty = True
+        return entry['value']
+
+    log.debug("Compiling '{0}'".format(filepath))
+    value = compile_file(filepath)
+    self.entries[filepath] = {'key': key,'digest': digest,'value': value}
+    self._dirty = True
+    return value
+
+  def save(self):
+    """
+    Write the cache back out if anything changed, forgetting files
+    that weren't looked up this time.
+    """
+    for filepath in set(self.entries) - self._seen:
+      del self.entries[filepath]
+      self._dirty = True
+
+    if not self._dirty:
+      return
+
+    try:
+      cachedir = os.path.dirname(self.path)
+      if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+      tmppath = self.path + ".tmp"
+      with open(tmppath,'wb') as cachefile:
+        cPickle.dump({'version': self.VERSION,
+                      'salt': self.salt,
+                      'entries': self.entries},
+                     cachefile,cPickle.HIGHEST_PROTOCOL)
+      os.rename(tmppath,self.path)
+    except (IOError,OSError) as e:
+      log.debug("Unable to write cache '{0}' [{1}]".format(self.path,e))
+    else:
+      self._dirty = False
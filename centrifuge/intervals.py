@@ -0,0 +1,132 @@
+"""
+Backup intervals (tiers) and when they fall due.
+
+The built-in intervals are *daily*, *weekly* and *monthly*. They are
+configured with a plain count on the archive, e.g. ``daily: 7``. Any
+other interval is declared in the archive's ``intervals`` map with how
+often it runs and how many instances to keep::
+
+  database:
+    files: [/var/backups/db]
+    service: tarsnap
+    daily: 7
+    intervals:
+      hourly: { every: 1h, keep: 24 }
+      quarter: { every: 15m, keep: 8 }
+
+Intervals of whole days are due once the calendar date has moved on
+far enough, just like they have always been. Shorter intervals are
+compared on timestamps, allowing a little slack so a cron job that
+fires a few seconds early doesn't skip a whole period.
+"""
+import datetime
+
+import util
+
+BUILTIN = {
+  'daily': datetime.timedelta(days=1),
+  'weekly': datetime.timedelta(days=7),
+  'monthly': datetime.timedelta(days=30)
+}
+
+# Sub-daily intervals may fire this fraction of a period early...
+SLACK_FRACTION = 0.05
+# ...but never more than this much early.
+MAX_SLACK = datetime.timedelta(minutes=5)
+
+class Interval(object):
+
+  def __init__(self,name,period,keep):
+    self.name = name
+    self.period = period
+    self.keep = keep
+
+  def __repr__(self):
+    return "{{interval: {0}, every: {1}, keep: {2}}}".format(self.name,self.period,self.keep)
+
+  @property
+  def whole_days(self):
+    return self.period.seconds == 0 and self.period.microseconds == 0
+
+  @property
+  def slack(self):
+    return min(MAX_SLACK,datetime.timedelta(
+                    seconds=self.period.total_seconds() * SLACK_FRACTION))
+
+  def since(self,created,now):
+    """ How long it has been since *created*, the way this interval counts it """
+    if self.whole_days:
+      return now.date() - _as_date(created)
+    return now - as_datetime(created)
+
+  def is_due(self,created,now):
+    """ Is a new instance due at *now* if the latest was *created*? """
+    if created is None:
+      return True
+    if self.whole_days:
+      return self.since(created,now) >= self.period
+    return self.since(created,now) >= self.period - self.slack
+
+  def next_due(self,created):
+    """ The earliest time a new instance is due after one *created* """
+    if created is None:
+      return datetime.datetime.min
+    if self.whole_days:
+      return datetime.datetime.combine(_as_date(created) + self.period,datetime.time())
+    return as_datetime(created) + self.period - self.slack
+
+def configured(bconfig):
+  """
+  The intervals archive config *bconfig* keeps instances for, shortest
+  first.
+  """
+  found = [Interval(name,period,bconfig[name])
+           for name,period in BUILTIN.iteritems()
+           if bconfig.get(name,0) > 0]
+  for name,spec in bconfig.get('intervals',{}).iteritems():
+    if spec['keep'] > 0:
+      period = datetime.timedelta(seconds=util.parse_duration(spec['every']))
+      found.append(Interval(name,period,spec['keep']))
+
+  return sorted(found,key=lambda interval: interval.period)
+
+def signature(configured):
+  """
+  A string that changes whenever the due times of the intervals in
+  *configured* could.
+  """
+  return ",".join(sorted("{0}={1:g}".format(interval.name,interval.period.total_seconds())
+                         for interval in configured))
+
+def check(name,bconfig):
+  """
+  Problems with the interval definitions of archive *name*, in the
+  same form BackupConfig.validate reports them.
+  """
+  errors = []
+  for interval,spec in bconfig.get('intervals',{}).iteritems():
+    path = "{0}.intervals.{1}".format(name,interval)
+    if str(interval).startswith("last_"):
+      errors.append("{0}: interval names can't start with 'last_'".format(path))
+    if interval in BUILTIN and interval in bconfig:
+      errors.append("{0}: also configured as '{1}: {2}'".format(
+                      path,interval,bconfig[interval]))
+    try:
+      seconds = util.parse_duration(spec['every'])
+    except Exception:
+      errors.append("{0}.every: invalid duration '{1}'".format(path,spec['every']))
+    else:
+      if seconds < 60:
+        errors.append("{0}.every: must be at least a minute".format(path))
+  return errors
+
+def as_datetime(created):
+  """ Instances used to only record a date. Treat those as midnight. """
+  if isinstance(created,datetime.datetime):
+    return created
+  return datetime.datetime.combine(created,datetime.time())
+
+def _as_date(created):
+  if isinstance(created,datetime.datetime):
+    return created.date()
+  return created
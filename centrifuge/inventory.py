@@ -0,0 +1,161 @@
+"""
+Reconcile the State with the archives a service really holds.
+
+The State is Centrifuge's only record of what exists remotely. A create
+whose state write was lost leaks an archive nobody will ever retire,
+and an archive deleted by hand makes every later delete of it fail. A
+service that provides *cmd_list* can be asked for its whole inventory
+in one call, which is diffed against the State in a single pass:
+
+adopt
+  Archives the service holds that look like ours but that the State
+  doesn't know about.
+
+forget
+  Archives the State knows about that the service no longer holds.
+
+Inventories are cached per service for a while, since listing can be
+slow and expensive. Centrifuge drops a service's cached inventory
+whenever a run creates or deletes archives with it.
+"""
+import os
+import time
+import cPickle
+import logging
+import datetime
+
+import state
+
+log = logging.getLogger("centrifuge.inventory")
+
+__ALL__ = [ "InventoryCache",
+            "fetch",
+            "diff"
+          ]
+
+class InventoryCache(object):
+
+  VERSION = 1
+
+  def __init__(self,path,entries=None):
+    self.path = path
+    self.entries = entries if entries else {}
+    self._dirty = False
+
+  @classmethod
+  def Load(cls,path):
+    """ Load the cache stored at *path*. A missing or unreadable cache is empty. """
+    try:
+      with open(path,'rb') as cachefile:
+        stored = cPickle.load(cachefile)
+    except IOError:
+      return cls(path)
+    except Exception as e:
+      log.debug("Ignoring unreadable inventory cache '{0}' [{1}]".format(path,e))
+      return cls(path)
+
+    if stored.get('version') != cls.VERSION:
+      return cls(path)
+    return cls(path,stored['entries'])
+
+  def get(self,bservice,max_age,now):
+    """
+    The cached inventory of *bservice* if it was fetched, with the same
+    list command, less than *max_age* seconds before *now*.
+    """
+    entry = self.entries.get(bservice.name)
+    if (entry and entry['command'] == bservice.list
+        and 0 <= now - entry['fetched'] <= max_age):
+      return entry
+    return None
+
+  def put(self,bservice,archives,fetched):
+    entry = {'command': bservice.list,'fetched': fetched,'archives': archives}
+    self.entries[bservice.name] = entry
+    self._dirty = True
+    return entry
+
+  def invalidate(self,service_names):
+    """ Forget the inventories of every service in *service_names* """
+    for name in service_names:
+      if self.entries.pop(name,None) is not None:
+        self._dirty = True
+
+  def save(self):
+    """ Write the cache back out, if anything changed """
+    if not self._dirty:
+      return
+    try:
+      cachedir = os.path.dirname(self.path)
+      if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+      tmppath = self.path + ".tmp"
+      with open(tmppath,'wb') as cachefile:
+        cPickle.dump({'version': self.VERSION,'entries': self.entries},
+                     cachefile,cPickle.HIGHEST_PROTOCOL)
+      os.rename(tmppath,self.path)
+    except (IOError,OSError) as e:
+      log.debug("Unable to write inventory cache '{0}' [{1}]".format(self.path,e))
+    else:
+      self._dirty = False
+
+def fetch(bservice,cache,max_age,refresh=False):
+  """
+  Return the archives *bservice* holds and when that list was fetched,
+  using *cache* unless it is older than *max_age* seconds or *refresh*
+  is set.
+  """
+  now = time.time()
+  entry = None if refresh else cache.get(bservice,max_age,now)
+  if entry is None:
+    log.info("Fetching the archive list of '{0}'".format(bservice.name))
+    entry = cache.put(bservice,bservice.inventory(),now)
+  else:
+    log.info("Using the archive list of '{0}' from {1:.0f}s ago".format(
+                bservice.name,now - entry['fetched']))
+  return entry['archives'],datetime.datetime.fromtimestamp(entry['fetched'])
+
+def diff(states,backups,archives,fetched,pending=frozenset()):
+  """
+  Compare the *archives* a service holds, as of *fetched*, with the
+  states in *backups*, a dict of state keys to the name of the archive
+  each state keeps (which differ for an archive's secondary services).
+
+  Archives in *pending* are waiting to be deleted and are neither
+  adopted nor forgotten. Neither are instances created after the list
+  was fetched, which the list can't know about yet.
+
+  Returns ``(adopt, forget, foreign)``: ``(backup, instance)`` tuples
+  to adopt, ``(backup, interval, instance)`` tuples to forget, and how
+  many of the archives aren't Centrifuge archives of *backups* at all.
+  """
+  known = set()
+  forget = []
+  for backup in backups:
+    bstate = states.get(backup)
+    if bstate is None:
+      continue
+    for interval in bstate.intervals():
+      for instance in bstate[interval]:
+        name = str(instance)
+        known.add(name)
+        if name not in archives and instance.created_at < fetched:
+          forget.append((backup,interval,instance))
+
+  keys = dict((name,backup) for backup,name in backups.iteritems())
+  adopt = []
+  foreign = 0
+  for name in archives:
+    if name in known or name in pending:
+      continue
+    instance = state.BackupInstance.Parse(name)
+    # A name from the future isn't one of ours, and adopting it would
+    # stop its interval from falling due.
+    if (instance is None or instance.name not in keys
+        or instance.created_at > fetched):
+      foreign += 1
+    else:
+      adopt.append((keys[instance.name],instance))
+
+  adopt.sort(key=lambda pair: (pair[0],pair[1].created_at))
+  return adopt,forget,foreign
@@ -0,0 +1,236 @@
+"""
+Timing and outcome metrics for a run.
+
+A single Recorder per process collects how long each phase of a run
+took (loading the configuration, services and state, planning,
+creating, deleting, writing the state back), every service command
+that was run with its wall time, exit status and output size, and the
+outcome of each archive.
+
+At the end of a run the Recorder is written out twice: as a JSON run
+summary, and optionally as a Prometheus textfile for node_exporter's
+textfile collector. Both are replaced atomically, so a scrape or a
+reader never sees half a file.
+"""
+import os
+import time
+import logging
+import datetime
+import threading
+import contextlib
+
+import profiling
+
+log = logging.getLogger("centrifuge.metrics")
+
+__ALL__ = [ "Recorder",
+            "reset",
+            "current",
+            "phase",
+            "record_command",
+            "record_archive"
+          ]
+
+class Recorder(object):
+
+  def __init__(self):
+    self.started = time.time()
+    self.phases = {}
+    self.commands = []
+    self.archives = {}
+    self._lock = threading.RLock()
+
+  def add_phase(self,name,seconds):
+    with self._lock:
+      total,count = self.phases.get(name,(0.0,0))
+      self.phases[name] = (total + seconds,count + 1)
+
+  def add_command(self,op,result,service=None,backup=None,archives=1):
+    with self._lock:
+      self.commands.append({
+        'op': op,
+        'service': service,
+        'backup': backup,
+        'archives': archives,
+        'seconds': round(result.elapsed,3),
+        'status': result.returncode,
+        'bytes': result.bytes_read,
+        'attempts': result.attempts,
+        'retry_wait': round(result.waited,3),
+        'killed': result.killed
+      })
+
+  def add_archive(self,backup,ok,seconds):
+    with self._lock:
+      self.archives[backup] = {'ok': bool(ok),'seconds': round(seconds,3)}
+
+  def summary(self,success,last_created=None):
+    """
+    The run as a dict. *last_created* maps (backup, interval) to when
+    that interval last got a new instance, as a datetime.
+    """
+    with self._lock:
+      finished = time.time()
+      by_backup = {}
+      for command in self.commands:
+        if command['backup'] is not None:
+          by_backup[command['backup']] = by_backup.get(command['backup'],0) + command['bytes']
+      archives = dict((backup,dict(outcome,bytes=by_backup.get(backup,0)))
+                      for backup,outcome in self.archives.iteritems())
+
+      return {
+        'started': _iso(self.started),
+        'finished': _iso(finished),
+        'seconds': round(finished - self.started,3),
+        'success': bool(success),
+        'phases': dict((name,{'seconds': round(total,3),'count': count})
+                       for name,(total,count) in self.phases.iteritems()),
+        'archives': archives,
+        'commands': list(self.commands),
+        'last_created': dict(("{0}/{1}".format(backup,interval),when.isoformat())
+                             for (backup,interval),when
+                             in (last_created or {}).iteritems())
+      }
+
+  def textfile(self,summary,last_created=None):
+    """ *summary* in the Prometheus text exposition format """
+    lines = []
+    def metric(name,kind,helptext,samples):
+      lines.append("# HELP {0} {1}".format(name,helptext))
+      lines.append("# TYPE {0} {1}".format(name,kind))
+      for labels,value in samples:
+        lines.append("{0}{1} {2}".format(name,_labels(labels),_number(value)))
+
+    metric("centrifuge_run_start_timestamp_seconds","gauge",
+           "When the last run started.",[({},self.started)])
+    metric("centrifuge_run_duration_seconds","gauge",
+           "How long the last run took.",[({},summary['seconds'])])
+    metric("centrifuge_run_success","gauge",
+           "Whether the last run succeeded.",[({},summary['success'])])
+
+    metric("centrifuge_phase_duration_seconds","gauge",
+           "Time spent in each phase of the last run.",
+           [({'phase': name},phase['seconds'])
+            for name,phase in sorted(summary['phases'].iteritems())])
+
+    commands = {}
+    for command in summary['commands']:
+      key = (command['op'],command['service'] or "")
+      seconds,count,failed,outbytes,retries,waited,killed = commands.get(key,(0.0,0,0,0,0,0.0,0))
+      commands[key] = (seconds + command['seconds'],count + 1,
+                       failed + (command['status'] != 0 or bool(command['killed'])),
+                       outbytes + command['bytes'],retries + command['attempts'] - 1,
+                       waited + command['retry_wait'],killed + bool(command['killed']))
+    samples = sorted(commands.iteritems())
+    metric("centrifuge_command_seconds","gauge",
+           "Total wall time of the service commands run by the last run.",
+           [({'op': op,'service': service},value[0]) for (op,service),value in samples])
+    metric("centrifuge_commands","gauge",
+           "Service commands run by the last run.",
+           [({'op': op,'service': service},value[1]) for (op,service),value in samples])
+    metric("centrifuge_command_failures","gauge",
+           "Service commands that failed in the last run.",
+           [({'op': op,'service': service},value[2]) for (op,service),value in samples])
+    metric("centrifuge_command_output_bytes","gauge",
+           "Output produced by the service commands of the last run.",
+           [({'op': op,'service': service},value[3]) for (op,service),value in samples])
+    metric("centrifuge_command_retries","gauge",
+           "Retries of service commands in the last run.",
+           [({'op': op,'service': service},value[4]) for (op,service),value in samples])
+    metric("centrifuge_command_retry_wait_seconds","gauge",
+           "Time spent waiting to retry service commands in the last run.",
+           [({'op': op,'service': service},value[5]) for (op,service),value in samples])
+    metric("centrifuge_command_killed","gauge",
+           "Service commands killed for running too long or stalling in the last run.",
+           [({'op': op,'service': service},value[6]) for (op,service),value in samples])
+
+    archives = sorted(summary['archives'].iteritems())
+    metric("centrifuge_archive_duration_seconds","gauge",
+           "How long each archive took in the last run.",
+           [({'backup': backup},outcome['seconds']) for backup,outcome in archives])
+    metric("centrifuge_archive_success","gauge",
+           "Whether each archive succeeded in the last run.",
+           [({'backup': backup},outcome['ok']) for backup,outcome in archives])
+    metric("centrifuge_archive_output_bytes","gauge",
+           "Output produced creating each archive in the last run.",
+           [({'backup': backup},outcome['bytes']) for backup,outcome in archives])
+
+    metric("centrifuge_archive_last_created_timestamp_seconds","gauge",
+           "When each interval of each configured archive last got a new instance, "
+           "or was found unchanged.",
+           [({'backup': backup,'interval': interval},_timestamp(when))
+            for (backup,interval),when in sorted((last_created or {}).iteritems())])
+
+    return "\n".join(lines) + "\n"
+
+_recorder = Recorder()
+
+def reset():
+  """ Start recording a new run """
+  global _recorder
+  _recorder = Recorder()
+  return _recorder
+
+def current():
+  return _recorder
+
+# The phases running in each thread, innermost last, as the seconds
+# spent so far in the phases nested in them.
+_nested = threading.local()
+
+@contextlib.contextmanager
+def phase(name):
+  """
+  Time the enclosed block as (part of) the phase *name*, profiling it
+  too if profiling was started. Phases nested in it in the same thread
+  are timed on their own and left out of its time.
+  """
+  nested = _nested.__dict__.setdefault('seconds',[])
+  nested.append(0.0)
+  start = time.time()
+  try:
+    with profiling.section(name):
+      yield
+  finally:
+    seconds = time.time() - start
+    inner = nested.pop()
+    if nested:
+      nested[-1] += seconds
+    _recorder.add_phase(name,seconds - inner)
+
+def record_command(op,result,service=None,backup=None,archives=1):
+  """ Record the runner.CommandResult *result* of an *op* command """
+  _recorder.add_command(op,result,service,backup,archives)
+
+def record_archive(backup,ok,seconds):
+  _recorder.add_archive(backup,ok,seconds)
+
+def write_atomic(path,text):
+  """ Replace *path* with *text* without readers ever seeing a partial file """
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+  tmppath = "{0}.{1}.tmp".format(path,os.getpid())
+  with open(tmppath,'w') as outf:
+    outf.write(text)
+  os.rename(tmppath,path)
+
+def _iso(timestamp):
+  return datetime.datetime.fromtimestamp(timestamp).replace(microsecond=0).isoformat()
+
+def _timestamp(when):
+  return time.mktime(when.timetuple())
+
+def _number(value):
+  if value is True or value is False:
+    return "1" if value else "0"
+  return repr(value) if isinstance(value,float) else str(value)
+
+def _labels(labels):
+  if not labels:
+    return ""
+  return "{" + ",".join('{0}="{1}"'.format(key,_escape(value))
+                        for key,value in sorted(labels.iteritems())) + "}"
+
+def _escape(value):
+  return str(value).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
@@ -0,0 +1,198 @@
+"""
+Decide what a run will do before doing any of it.
+
+make_plan looks at every requested archive and each of its intervals
+against the State, and returns a Plan: for each archive, the archives
+to create (and which other intervals to tag them into), and the
+instances each create retires once it has succeeded. A retired
+instance that another interval still keeps is only untagged; one that
+nothing keeps any more is deleted.
+
+Nothing is run while planning, so a plan can be printed (``run
+--dry-run``) or handed to Centrifuge.apply_plan, which runs every
+create first and then deletes everything the plan retired in as few,
+batched service calls as possible.
+"""
+import json
+import logging
+
+import intervals
+
+log = logging.getLogger("centrifuge.planner")
+
+__ALL__ = [ "Create",
+            "ArchivePlan",
+            "Plan",
+            "make_plan",
+            "latest_created"
+          ]
+
+class Create(object):
+  """
+  One archive to create for *interval*, also tagged into *tags*, and
+  the (interval, instance) pairs to *retire* once it exists.
+  """
+
+  def __init__(self,interval,tags=None):
+    self.interval = interval
+    self.tags = tags if tags else []
+    self.retire = []
+
+  def as_dict(self):
+    return {
+      'interval': self.interval,
+      'tags': self.tags,
+      'retire': [{'archive': str(instance),'interval': interval}
+                 for interval,instance in self.retire]
+    }
+
+class ArchivePlan(object):
+  """ What a run will do to one archive """
+
+  def __init__(self,backup,service):
+    self.backup = backup
+    self.service = service
+    self.creates = []
+
+  def __nonzero__(self):
+    return bool(self.creates)
+
+  def deletions(self,bstate):
+    """
+    The instances of *bstate* that no interval keeps once every create
+    has succeeded, oldest first. Anything else retired is only untagged.
+    """
+    retired = {}
+    for create in self.creates:
+      for interval,instance in create.retire:
+        retired.setdefault(str(instance),(instance,set()))[1].add(interval)
+
+    holders = dict((name,set()) for name in retired)
+    for interval in bstate.intervals():
+      for instance in bstate[interval]:
+        name = str(instance)
+        if name in holders:
+          holders[name].add(interval)
+
+    doomed = [instance for name,(instance,tiers) in retired.iteritems()
+              if holders[name] <= tiers]
+    return sorted(doomed,key=lambda instance: instance.created_at)
+
+  def as_dict(self,bstate=None):
+    return {
+      'backup': self.backup,
+      'service': self.service,
+      'creates': [create.as_dict() for create in self.creates],
+      'delete': [str(instance) for instance in self.deletions(bstate)] if bstate else []
+    }
+
+class Plan(object):
+
+  def __init__(self,now):
+    self.now = now
+    self.archives = []
+
+  def __len__(self):
+    return len(self.archives)
+
+  def __iter__(self):
+    return iter(self.archives)
+
+  def as_dict(self,states):
+    archives = [archive.as_dict(states.get(archive.backup)) for archive in self.archives]
+    deletes = {}
+    for archive in archives:
+      deletes[archive['service']] = deletes.get(archive['service'],0) + len(archive['delete'])
+    return {
+      'planned': self.now.isoformat(),
+      'creates': sum(len(archive['creates']) for archive in archives),
+      'deletes': deletes,
+      'archives': archives
+    }
+
+  def to_json(self,states):
+    return json.dumps(self.as_dict(states),indent=2,sort_keys=True)
+
+def latest_created(bstate,interval,checked=None):
+  """
+  When the latest *interval* instance in *bstate* was created, if any.
+  *checked* maps intervals to when the archive's files were last found
+  unchanged, which counts as a backup too.
+  """
+  try:
+    created = bstate["last_{0}".format(interval.name)].date_created
+  except (KeyError,TypeError):
+    created = None
+  when = checked.get(interval.name) if checked else None
+  if when is not None and (created is None or when > intervals.as_datetime(created)):
+    return when
+  return created
+
+def is_due(bstate,interval,now,checked=None):
+  """ Return True if *bstate* is due for a backup at *interval* at *now* """
+  created = latest_created(bstate,interval,checked)
+  if interval.is_due(created,now):
+    return True
+
+  log.info("Skipping '{0}' interval. It's only been {1}".format(
+              interval.name,interval.since(created,now)))
+  return False
+
+def make_plan(config,states,backups,now,checked=None):
+  """
+  Plan a run of the archives named in *backups* at *now*, where
+  *config* maps each name to its configuration (with a single
+  service; see BackupConfig.targets). Names that aren't configured
+  are skipped with a warning, and each archive is only planned once.
+  *checked*, if given, returns the latest_created *checked* mapping of
+  an archive name.
+  """
+  plan = Plan(now)
+  seen = set()
+  for backup in backups:
+    if backup in seen:
+      continue
+    seen.add(backup)
+    try:
+      bconfig = config[backup]
+    except KeyError:
+      log.warn("No configured backup with name '{0}'".format(backup))
+      continue
+
+    archive = plan_archive(backup,bconfig,states.get(backup),now,
+                           checked(backup) if checked else None)
+    if archive:
+      plan.archives.append(archive)
+  return plan
+
+def plan_archive(backup,bconfig,bstate,now,checked=None):
+  """
+  Plan one archive. With *gfs* one new archive serves every interval
+  that is due. Otherwise each due interval gets its own.
+  """
+  archive = ArchivePlan(backup,bconfig['service'])
+  due = [interval for interval in intervals.configured(bconfig)
+         if is_due(bstate,interval,now,checked)]
+  if not due:
+    return archive
+
+  if bconfig.get('gfs',False):
+    create = Create(due[0].name,[interval.name for interval in due[1:]])
+    archive.creates.append(create)
+    for interval in due:
+      create.retire.extend(_surplus(bstate,interval))
+  else:
+    for interval in due:
+      create = Create(interval.name)
+      create.retire.extend(_surplus(bstate,interval))
+      archive.creates.append(create)
+  return archive
+
+def _surplus(bstate,interval):
+  """
+  The (interval, instance) pairs *interval* drops once it gains a new
+  instance: however many of its oldest take it over *keep*.
+  """
+  tier = bstate.get(interval.name,[]) if bstate is not None else []
+  surplus = len(tier) + 1 - interval.keep
+  return [(interval.name,instance) for instance in tier[:max(surplus,0)]]
@@ -0,0 +1,217 @@
+"""
+Profile a run phase by phase.
+
+With ``--profile`` every phase metrics times (loading services, the
+configuration and the state, planning, creating, deleting, flushing
+the state) also runs under cProfile, with a profile per phase and per
+thread, so archives running on parallel workers are covered too. A
+phase run inside another one gets a profile of its own, and the
+enclosing phase's profile is paused meanwhile. ``--trace-alloc``
+snapshots tracemalloc around each outermost phase and keeps what it
+allocated and didn't free, by source line.
+
+Reports are written to a directory per run next to the run summary:
+
+<phase>.pstats
+  The phase's profile, for ``python -m pstats`` or snakeviz.
+
+<phase>.txt
+  The functions with the most cumulative time.
+
+<phase>.alloc.txt
+  The lines that allocated the most memory during the phase.
+
+run.pstats
+  Every phase together.
+
+tracemalloc is part of Python 3.4 and later. On older Pythons it needs
+the pytracemalloc backport, and ``--trace-alloc`` is skipped without it.
+"""
+import os
+import logging
+import threading
+
+log = logging.getLogger("centrifuge.profiling")
+
+__ALL__ = [ "Profiler",
+            "start",
+            "stop",
+            "section"
+          ]
+
+class Profiler(object):
+
+  # How many frames tracemalloc keeps per allocation.
+  FRAMES = 1
+
+  def __init__(self,profile=True,trace_alloc=False,top=25):
+    self.profile = profile
+    self.top = top
+    self.peak = None
+    self.tracemalloc = None
+    if trace_alloc:
+      try:
+        import tracemalloc
+      except ImportError:
+        log.warn("tracemalloc isn't available in this Python. Not tracing allocations")
+      else:
+        self.tracemalloc = tracemalloc
+        if not tracemalloc.is_tracing():
+          tracemalloc.start(self.FRAMES)
+
+    # (phase, thread) -> cProfile.Profile. Re-enabling one adds to it.
+    self._profiles = {}
+    # phase -> {line: [size, count]} allocated and not freed
+    self._allocs = {}
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._depth = 0
+
+  def section(self,name):
+    return _Section(self,name)
+
+  def _enter(self,name):
+    """ Start profiling *name* in this thread. Returns what _exit needs. """
+    prof = None
+    # The sections being profiled in this thread, innermost last, as
+    # (name, profile). Only one profile can be enabled per thread.
+    active = self._local.__dict__.setdefault('active',[])
+    if self.profile and not (active and active[-1][0] == name):
+      import cProfile
+      key = (name,threading.current_thread().ident)
+      with self._lock:
+        prof = self._profiles.get(key)
+        if prof is None:
+          prof = self._profiles[key] = cProfile.Profile()
+      if active:
+        active[-1][1].disable()
+      active.append((name,prof))
+      prof.enable()
+
+    snapshot = None
+    if self.tracemalloc:
+      # Allocations are traced process wide, so only the outermost
+      # phase (in any thread) takes snapshots.
+      with self._lock:
+        self._depth += 1
+        outermost = self._depth == 1
+      if outermost:
+        snapshot = self.tracemalloc.take_snapshot()
+    return prof,snapshot
+
+  def _exit(self,name,prof,snapshot):
+    if prof is not None:
+      prof.disable()
+      active = self._local.active
+      active.pop()
+      if active:
+        active[-1][1].enable()
+
+    if self.tracemalloc:
+      if snapshot is not None:
+        diff = self.tracemalloc.take_snapshot().compare_to(snapshot,'lineno')
+        with self._lock:
+          lines = self._allocs.setdefault(name,{})
+          for stat in diff:
+            if stat.size_diff <= 0:
+              continue
+            frame = stat.traceback[0]
+            totals = lines.setdefault("{0}:{1}".format(frame.filename,frame.lineno),[0,0])
+            totals[0] += stat.size_diff
+            totals[1] += stat.count_diff
+      with self._lock:
+        self._depth -= 1
+
+  def stop(self):
+    if self.tracemalloc and self.tracemalloc.is_tracing():
+      self.peak = self.tracemalloc.get_traced_memory()[1]
+      self.tracemalloc.stop()
+
+  def write(self,directory):
+    """ Write every report into *directory*. Returns the files written. """
+    import pstats
+    import StringIO
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    written = []
+
+    by_phase = {}
+    for (name,thread),prof in self._profiles.iteritems():
+      by_phase.setdefault(name,[]).append(prof)
+    for name,profiles in sorted(by_phase.iteritems()):
+      stats = pstats.Stats(*profiles)
+      path = os.path.join(directory,"{0}.pstats".format(name))
+      stats.dump_stats(path)
+      written.append(path)
+
+      report = StringIO.StringIO()
+      pstats.Stats(*profiles,stream=report).sort_stats('cumulative').print_stats(self.top)
+      written.append(self._write(directory,"{0}.txt".format(name),report.getvalue()))
+
+    if by_phase:
+      path = os.path.join(directory,"run.pstats")
+      pstats.Stats(*self._profiles.values()).dump_stats(path)
+      written.append(path)
+
+    for name,lines in sorted(self._allocs.iteritems()):
+      ranked = sorted(lines.iteritems(),key=lambda item: item[1][0],reverse=True)
+      report = ["Allocated and not freed during '{0}', top {1} lines".format(name,self.top)]
+      if self.peak is not None:
+        report.append("Peak traced memory over the run: {0} bytes".format(self.peak))
+      report.append("")
+      for line,(size,count) in ranked[:self.top]:
+        report.append("{0:>12} B {1:>9} blocks  {2}".format(size,count,line))
+      written.append(self._write(directory,"{0}.alloc.txt".format(name),"\n".join(report) + "\n"))
+
+    return written
+
+  @staticmethod
+  def _write(directory,filename,text):
+    path = os.path.join(directory,filename)
+    with open(path,'w') as outf:
+      outf.write(text)
+    return path
+
+class _Section(object):
+
+  def __init__(self,profiler,name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.state = self.profiler._enter(self.name)
+
+  def __exit__(self,*exc):
+    self.profiler._exit(self.name,*self.state)
+
+class _Nothing(object):
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self,*exc):
+    pass
+
+_NOTHING = _Nothing()
+_profiler = None
+
+def start(profile=True,trace_alloc=False,top=25):
+  """ Start profiling every section from now on """
+  global _profiler
+  _profiler = Profiler(profile,trace_alloc,top)
+  return _profiler
+
+def stop():
+  """ Stop profiling. Returns the Profiler, to write its reports. """
+  global _profiler
+  profiler,_profiler = _profiler,None
+  if profiler is not None:
+    profiler.stop()
+  return profiler
+
+def section(name):
+  """ Profile the enclosed block as (part of) *name*, if profiling """
+  if _profiler is None:
+    return _NOTHING
+  return _profiler.section(name)
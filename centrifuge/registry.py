@@ -0,0 +1,24 @@
+"""
+A persistent cache of compiled BackupServices.
+
+Service specification files rarely change, but parsing every one of
+them on every invocation adds up when many are installed. The cache
+stores the compiled services of each file, keyed on its path, mtime
+and size, together with a digest of the user variables they were
+compiled with. Only files that changed are parsed again.
+"""
+import yaml
+import hashlib
+
+from filecache import FileCache
+
+class ServiceRegistryCache(FileCache):
+
+  # Compiled services gained their stats expressions, their limits, how
+  # they take file lists, how they exclude files, then their commands
+  # split into arguments.
+  VERSION = 6
+
+  def __init__(self,path,uservars):
+    FileCache.__init__(self,path,
+        salt=hashlib.sha1(yaml.safe_dump(uservars,default_flow_style=True)).hexdigest())
@@ -0,0 +1,285 @@
+"""
+Run backup service commands.
+
+Output is forwarded to the log line by line while the command runs,
+rather than being buffered until it exits. Only a bounded tail of the
+output is kept around for error reports, so a long, chatty create
+doesn't hold its whole output in memory.
+
+A command can be given Limits: how long it may run in total, how long
+it may go without printing anything before it counts as stalled, and
+how often to retry it when it fails. A command with a time limit runs
+in a session of its own, so that when a limit is hit the whole process
+group is killed, not just the process we started.
+
+A command can also be given a file to read on its standard input,
+which is how services take long lists of files to back up.
+"""
+import os
+import sys
+import time
+import signal
+import random
+import logging
+import threading
+import subprocess
+import collections
+
+log = logging.getLogger("centrifuge.runner")
+
+__ALL__ = [ "CommandError",
+            "CommandResult",
+            "Limits",
+            "run"
+          ]
+
+class CommandError(Exception):
+
+  def __init__(self,result):
+    self.result = result
+
+  def __str__(self):
+    if self.result.killed:
+      status = "was killed ({0})".format(self.result.killed)
+    else:
+      status = "exited with status {0}".format(self.result.returncode)
+    if self.result.attempts > 1:
+      status += " after {0} attempts".format(self.result.attempts)
+    return "'{0}' {1}: {2}".format(" ".join(self.result.cmd),status,
+                                   self.result.output.strip())
+
+class Limits(object):
+  """
+  How long a command may take, and how often it is retried.
+
+  *timeout* and *stall* are in seconds (None for no limit): the
+  longest the command may run, and the longest it may go without
+  printing anything. A failed command is tried again up to *retries*
+  times, waiting *retry_delay* seconds before the first retry and
+  twice as long before each one after that, give or take some jitter.
+  Commands that were killed for a limit are always retried; ones that
+  exited non-zero only if *retry_on* is empty or lists their status.
+  """
+
+  # Backoff stops doubling here, unless retry_delay is longer.
+  MAX_BACKOFF = 600
+
+  def __init__(self,timeout=None,stall=None,retries=0,retry_delay=30,retry_on=None):
+    self.timeout = timeout
+    self.stall = stall
+    self.retries = retries
+    self.retry_delay = retry_delay
+    self.retry_on = frozenset(retry_on or ())
+
+  @property
+  def watched(self):
+    return bool(self.timeout or self.stall)
+
+  def should_retry(self,result,attempt):
+    if attempt > self.retries or result.returncode == 127:
+      # Out of retries, or the command couldn't even be started.
+      return False
+    return bool(result.killed or not self.retry_on or result.returncode in self.retry_on)
+
+  def backoff(self,attempt):
+    """ Seconds to wait before retrying after *attempt* failed """
+    delay = min(self.retry_delay * 2 ** (attempt - 1),max(self.MAX_BACKOFF,self.retry_delay))
+    # Half fixed, half random, so retries of many archives that failed
+    # together (say, the network went away) don't all land at once.
+    return delay / 2.0 + random.uniform(0,delay / 2.0)
+
+NO_LIMITS = Limits()
+
+class _Watchdog(threading.Thread):
+  """ Kill *proc*'s process group once it runs too long or goes quiet """
+
+  # How long the group gets to exit after SIGTERM before SIGKILL.
+  KILL_GRACE = 10
+
+  def __init__(self,cmd,proc,limits):
+    threading.Thread.__init__(self,name="centrifuge-watchdog-{0}".format(proc.pid))
+    self.daemon = True
+    self.cmd = cmd
+    self.proc = proc
+    self.limits = limits
+    self.started = self.last_output = time.time()
+    self.fired = None
+    self._done = threading.Event()
+    self._poll = min(1.0,min(limit for limit in (limits.timeout,limits.stall) if limit) / 4.0)
+
+  def touch(self):
+    self.last_output = time.time()
+
+  def stop(self):
+    self._done.set()
+
+  def run(self):
+    while not self._done.wait(self._poll):
+      now = time.time()
+      if self.limits.timeout and now - self.started > self.limits.timeout:
+        self.fired = "timed out after {0:.0f}s".format(self.limits.timeout)
+      elif self.limits.stall and now - self.last_output > self.limits.stall:
+        self.fired = "no output for {0:.0f}s".format(self.limits.stall)
+      else:
+        continue
+      log.warn("'{0}' (pid {1}) {2}. Killing it".format(self.cmd,self.proc.pid,self.fired))
+      _signal(self.proc,signal.SIGTERM,True)
+      if not self._done.wait(self.KILL_GRACE):
+        _signal(self.proc,signal.SIGKILL,True)
+      return
+
+def _signal(proc,signum,group):
+  """ Send *signum* to *proc*, or to its whole process group if *group* """
+  try:
+    if group:
+      os.killpg(proc.pid,signum)
+    else:
+      os.kill(proc.pid,signum)
+  except OSError:
+    # Already gone.
+    pass
+
+def _terminate(proc,group):
+  """
+  Stop *proc*, and everything in its process group if *group*: SIGTERM
+  first, and SIGKILL for whatever is left after KILL_GRACE.
+  """
+  _signal(proc,signal.SIGTERM,group)
+  deadline = time.time() + _Watchdog.KILL_GRACE
+  while proc.poll() is None and time.time() < deadline:
+    time.sleep(0.1)
+  if group or proc.poll() is None:
+    # Children can outlive the process we started.
+    _signal(proc,signal.SIGKILL,group)
+  proc.wait()
+
+class CommandResult(object):
+  """
+  What we know about a finished (or failed to start) command.
+  """
+
+  TAIL_LINES = 50
+
+  def __init__(self,cmd):
+    self.cmd = cmd
+    self.lines = None
+    self.returncode = None
+    # Wall time over every attempt, backoff included.
+    self.elapsed = 0.0
+    self.bytes_read = 0
+    self.tail = collections.deque(maxlen=self.TAIL_LINES)
+    # Why the watchdog killed the last attempt, if it did.
+    self.killed = None
+    self.attempts = 1
+    # Seconds spent waiting to retry.
+    self.waited = 0.0
+
+  @property
+  def ok(self):
+    # A command that exits cleanly once it is told to stop still didn't finish.
+    return self.returncode == 0 and not self.killed
+
+  @property
+  def output(self):
+    """ The last TAIL_LINES lines of output """
+    return "".join(self.tail)
+
+  def __repr__(self):
+    return ("{{cmd: {0}, status: {1}, elapsed: {2:.2f}s, bytes: {3}, attempts: {4}}}"
+                .format(self.cmd[0],self.returncode,self.elapsed,self.bytes_read,self.attempts))
+
+def run(cmd,logger=log,level=logging.DEBUG,collect=False,limits=None,stdin=None):
+  """
+  Run the argument list *cmd*, forwarding each line it prints to
+  *logger* at *level*. If *collect* is True every line is also kept
+  in the result's *lines*, for commands whose output is the point.
+  *limits* (Limits) bounds how long it may take and how often it is
+  retried. *stdin* is the path of a file the command reads on its
+  standard input; every attempt reads it from the start.
+
+  Returns a CommandResult, or raises CommandError if the command
+  couldn't be started or failed on every attempt.
+  """
+  limits = limits if limits is not None else NO_LIMITS
+  start = time.time()
+  attempt = 1
+  waited = 0.0
+  while True:
+    result = _run_once(cmd,logger,level,collect,limits,stdin)
+    if result.ok or not limits.should_retry(result,attempt):
+      break
+    delay = limits.backoff(attempt)
+    logger.warn("'{0}' failed ({1}). Retrying in {2:.1f}s ({3} of {4})".format(
+                  cmd[0],result.killed or "status {0}".format(result.returncode),
+                  delay,attempt,limits.retries))
+    time.sleep(delay)
+    waited += delay
+    attempt += 1
+
+  result.attempts = attempt
+  result.waited = waited
+  result.elapsed = time.time() - start
+  if not result.ok:
+    raise CommandError(result)
+
+  return result
+
+def _run_once(cmd,logger,level,collect,limits,stdin=None):
+  """ One attempt at running *cmd*. Never raises. """
+  result = CommandResult(cmd)
+  options = {}
+  if limits.watched:
+    # A session of its own, so the watchdog can kill everything it starts.
+    if sys.version_info >= (3,2):
+      options['start_new_session'] = True
+    else:
+      options['preexec_fn'] = os.setsid
+
+  try:
+    # A file rather than a pipe we write to, so a command that prints
+    # a lot before it reads everything can't deadlock with us.
+    options['stdin'] = open(stdin,'rb') if stdin else None
+    try:
+      proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT,
+                                  close_fds=True,**options)
+    finally:
+      if options['stdin']:
+        options['stdin'].close()
+  except (OSError,IOError) as e:
+    result.returncode = 127
+    result.tail.append(str(e))
+    return result
+
+  watchdog = None
+  if limits.watched:
+    watchdog = _Watchdog(cmd[0],proc,limits)
+    watchdog.start()
+
+  if collect:
+    result.lines = []
+  forward = logger.isEnabledFor(level)
+  try:
+    for line in iter(proc.stdout.readline,''):
+      if watchdog:
+        watchdog.touch()
+      result.bytes_read += len(line)
+      result.tail.append(line)
+      if collect:
+        result.lines.append(line)
+      if forward:
+        logger.log(level,"[{0}] {1}".format(cmd[0],line.rstrip()))
+
+    proc.stdout.close()
+    result.returncode = proc.wait()
+  finally:
+    if watchdog:
+      watchdog.stop()
+      watchdog.join()
+      result.killed = watchdog.fired
+    if proc.returncode is None:
+      # We're leaving early (Ctrl-C, say). A command in a session of
+      # its own never saw the interrupt, so it mustn't outlive us.
+      _terminate(proc,limits.watched)
+
+  return result
@@ -0,0 +1,117 @@
+"""
+When each archive next falls due.
+
+The DueIndex remembers the next due time of every interval of every
+archive, and keeps the earliest one per archive in a heap. Finding the
+archives that are due then costs time in proportion to how many are
+due, not to how many are configured, and nothing has to load an
+archive's state or resolve its service just to learn that it isn't due.
+
+Each archive's entry carries a *signature* of the intervals it was
+computed from. An archive whose intervals changed, or that is new, no
+longer matches and is simply computed again.
+"""
+import heapq
+import logging
+
+import state
+
+log = logging.getLogger("centrifuge.schedule")
+
+class DueIndex(object):
+
+  # The StateStore this index reports its changes to, if any.
+  journal = None
+
+  def __init__(self,entries=None):
+    # backup -> (signature, {interval: due})
+    self.entries = {}
+    # backup -> earliest due time, which is what the heap is ordered by.
+    self._when = {}
+    self._heap = []
+    self.dirty = False
+    for backup,(signature,dues) in (entries or {}).iteritems():
+      self._set(backup,signature,dues)
+    self.dirty = False
+
+  def __len__(self):
+    return len(self.entries)
+
+  def backups(self):
+    return self.entries.keys()
+
+  def signature(self,backup):
+    """ The signature *backup*'s due times were computed with, if any """
+    entry = self.entries.get(backup)
+    return entry[0] if entry else None
+
+  def due_times(self,backup):
+    """ When each interval of *backup* next falls due """
+    entry = self.entries.get(backup)
+    return dict(entry[1]) if entry else {}
+
+  def update(self,backup,signature,dues):
+    """
+    Record that the intervals of *backup* (computed with *signature*)
+    next fall due at the times in *dues*, a dict of interval names to
+    datetimes.
+    """
+    with state.lock:
+      self._set(backup,signature,dues)
+      if self.journal:
+        self.journal.record_schedule(backup,signature,dues)
+
+  def forget(self,backup):
+    """ Drop *backup* from the index, e.g. because it is no longer configured """
+    with state.lock:
+      if self.entries.pop(backup,None) is None:
+        return
+      self._when.pop(backup,None)
+      self.dirty = True
+      if self.journal:
+        self.journal.record_unschedule(backup)
+
+  def due(self,now):
+    """
+    Return the archives that are due at *now*, earliest first, and
+    when the next archive that isn't falls due (None if none will).
+    """
+    with state.lock:
+      due = []
+      while self._heap and self._heap[0][0] <= now:
+        item = heapq.heappop(self._heap)
+        if self._valid(item):
+          due.append(item)
+          # The same item can be queued twice. Take it only once.
+          self._when[item[1]] = None
+      for when,backup in due:
+        self._when[backup] = when
+
+      while self._heap and not self._valid(self._heap[0]):
+        heapq.heappop(self._heap)
+      wake = self._heap[0][0] if self._heap else None
+
+      # They stay due until they are updated.
+      for item in due:
+        heapq.heappush(self._heap,item)
+      return [backup for when,backup in due],wake
+
+  def _set(self,backup,signature,dues):
+    self.entries[backup] = (signature,dict(dues))
+    self.dirty = True
+    when = min(dues.values()) if dues else None
+    if when == self._when.get(backup):
+      return
+    if when is None:
+      self._when.pop(backup,None)
+      return
+    self._when[backup] = when
+    heapq.heappush(self._heap,(when,backup))
+    # Replaced entries are only dropped lazily. Don't let them pile up.
+    if len(self._heap) > 2 * len(self._when) + 64:
+      self._heap = [(when,backup) for backup,when in self._when.iteritems()]
+      heapq.heapify(self._heap)
+
+  def _valid(self,item):
+    when,backup = item
+    return self._when.get(backup) == when
@@ -0,0 +1,258 @@
+"""
+Compile Rx schemas into fast checkers that say *where* a value failed.
+
+The vendored Rx implementation only answers yes or no, and building its
+type objects means reparsing the schema every time. compile_schema turns
+a schema into a tree of plain closures once per process. Each checker
+takes the value, the path to it and a list to append errors to, and
+returns True if the value is valid. When no error list is given the
+checker stops at the first problem and doesn't build any paths, which
+keeps the common, valid case cheap.
+
+Only the Rx core types are compiled. Anything else falls back to Rx's
+own checker, without a precise path below that point.
+"""
+import logging
+
+from rx import Rx
+
+log = logging.getLogger("centrifuge.schema")
+
+__ALL__ = [ "SchemaChecker",
+            "compile_schema"
+          ]
+
+_NUMBERS = (int,long,float)
+_STRINGS = (str,unicode)
+_CORE = 'tag:codesimply.com,2008:rx/core/'
+
+_cache = {}
+
+class SchemaChecker(object):
+  """
+  A compiled schema. ``errors(value)`` returns a list of
+  ``"path: problem"`` strings, empty if *value* is valid.
+  """
+
+  def __init__(self,schema):
+    self.factory = Rx.Factory({"register_core_types": True})
+    # Let Rx complain about a malformed schema the way it always has.
+    self.factory.make_schema(schema)
+    self._check = self._compile(schema)
+
+  def check(self,value):
+    return self._check(value,"",None)
+
+  def errors(self,value,path=""):
+    errors = []
+    self._check(value,path,errors)
+    return errors
+
+  def _compile(self,schema):
+    if isinstance(schema,_STRINGS):
+      schema = {'type': schema}
+
+    uri = self.factory.expand_uri(schema['type'])
+    registered = self.factory.type_registry.get(uri)
+    if isinstance(registered,dict):
+      return self._compile(registered['schema'])
+
+    compiler = getattr(self,"_compile_{0}".format(uri[len(_CORE):]),None)
+    if not uri.startswith(_CORE) or compiler is None:
+      return self._compile_fallback(schema)
+    return compiler(schema)
+
+  def _compile_fallback(self,schema):
+    rx_checker = self.factory.make_schema(schema)
+    def check(value,path,errors):
+      if rx_checker.check(value):
+        return True
+      _fail(errors,path,"does not match {0}".format(schema['type']))
+      return False
+    return check
+
+  def _compile_any(self,schema):
+    if schema.get('of') is None:
+      return lambda value,path,errors: True
+    alts = [self._compile(alt) for alt in schema['of']]
+    def check(value,path,errors):
+      for alt in alts:
+        if alt(value,path,None):
+          return True
+      _fail(errors,path,"matches none of the allowed alternatives")
+      return False
+    return check
+
+  def _compile_all(self,schema):
+    alts = [self._compile(alt) for alt in schema['of']]
+    def check(value,path,errors):
+      okay = True
+      for alt in alts:
+        okay = alt(value,path,errors) and okay
+        if not okay and errors is None:
+          return False
+      return okay
+    return check
+
+  def _compile_one(self,schema):
+    scalars = _NUMBERS + _STRINGS + (bool,)
+    return _simple(lambda value: type(value) in scalars,"expected a single value")
+
+  def _compile_def(self,schema):
+    return _simple(lambda value: value is not None,"must be defined")
+
+  def _compile_nil(self,schema):
+    return _simple(lambda value: value is None,"expected nothing (null)")
+
+  def _compile_fail(self,schema):
+    return _simple(lambda value: False,"is not allowed")
+
+  def _compile_bool(self,schema):
+    return _simple(lambda value: value is True or value is False,"expected true or false")
+
+  def _compile_int(self,schema):
+    return self._compile_number(schema,True)
+
+  def _compile_num(self,schema):
+    return self._compile_number(schema,False)
+
+  def _compile_number(self,schema,integer):
+    in_range = Rx.Util.make_range_check(schema['range']) if schema.get('range') else None
+    expected = schema.get('value')
+    what = "an integer" if integer else "a number"
+    def check(value,path,errors):
+      if type(value) not in _NUMBERS or (integer and value % 1 != 0):
+        return _fail(errors,path,"expected {0}, got {1!r}".format(what,value))
+      if in_range and not in_range(value):
+        return _fail(errors,path,"{0} is out of range {1}".format(value,schema['range']))
+      if expected is not None and value != expected:
+        return _fail(errors,path,"expected {0}, got {1}".format(expected,value))
+      return True
+    return check
+
+  def _compile_str(self,schema):
+    length = Rx.Util.make_range_check(schema['length']) if schema.get('length') else None
+    expected = schema.get('value')
+    def check(value,path,errors):
+      if type(value) not in _STRINGS:
+        return _fail(errors,path,"expected a string, got {0!r}".format(value))
+      if expected is not None and value != expected:
+        return _fail(errors,path,"expected '{0}', got '{1}'".format(expected,value))
+      if length and not length(len(value)):
+        return _fail(errors,path,"length {0} is out of range {1}".format(len(value),schema['length']))
+      return True
+    return check
+
+  def _compile_arr(self,schema):
+    contents = self._compile(schema['contents'])
+    length = Rx.Util.make_range_check(schema['length']) if schema.get('length') else None
+    def check(value,path,errors):
+      if type(value) not in (list,tuple):
+        return _fail(errors,path,"expected a list, got {0!r}".format(value))
+      okay = True
+      if length and not length(len(value)):
+        okay = _fail(errors,path,"has {0} entries, allowed {1}".format(len(value),schema['length']))
+      for i,item in enumerate(value):
+        if not contents(item,errors is not None and "{0}[{1}]".format(path,i),errors):
+          okay = False
+          if errors is None:
+            break
+      return okay
+    return check
+
+  def _compile_seq(self,schema):
+    contents = [self._compile(s) for s in schema['contents']]
+    tail = self._compile(schema['tail']) if schema.get('tail') else None
+    def check(value,path,errors):
+      if type(value) not in (list,tuple):
+        return _fail(errors,path,"expected a list, got {0!r}".format(value))
+      if len(value) < len(contents):
+        return _fail(errors,path,"needs at least {0} entries".format(len(contents)))
+      okay = True
+      for i,item_check in enumerate(contents):
+        okay = item_check(value[i],errors is not None and "{0}[{1}]".format(path,i),errors) and okay
+      if len(value) > len(contents):
+        if not tail:
+          okay = _fail(errors,path,"has more than {0} entries".format(len(contents)))
+        else:
+          okay = tail(value[len(contents):],path,errors) and okay
+      return okay
+    return check
+
+  def _compile_map(self,schema):
+    values = self._compile(schema['values'])
+    def check(value,path,errors):
+      if type(value) is not dict:
+        return _fail(errors,path,"expected a mapping, got {0!r}".format(value))
+      okay = True
+      for key,item in value.iteritems():
+        if not values(item,errors is not None and _join(path,key),errors):
+          okay = False
+          if errors is None:
+            break
+      return okay
+    return check
+
+  def _compile_rec(self,schema):
+    required = dict((field,self._compile(sub))
+                    for field,sub in schema.get('required',{}).iteritems())
+    optional = dict((field,self._compile(sub))
+                    for field,sub in schema.get('optional',{}).iteritems())
+    fields = dict(optional,**required)
+    rest = self._compile(schema['rest']) if schema.get('rest') else None
+
+    def check(value,path,errors):
+      if type(value) is not dict:
+        return _fail(errors,path,"expected a mapping, got {0!r}".format(value))
+      okay = True
+      for field in required:
+        if field not in value:
+          okay = _fail(errors,_join(path,field),"is required")
+          if errors is None:
+            return False
+
+      unknown = {}
+      for field,item in value.iteritems():
+        field_check = fields.get(field)
+        if field_check is None:
+          unknown[field] = item
+        elif not field_check(item,errors is not None and _join(path,field),errors):
+          okay = False
+          if errors is None:
+            return False
+
+      if unknown:
+        if rest:
+          okay = rest(unknown,path,errors) and okay
+        else:
+          for field in sorted(unknown):
+            okay = _fail(errors,_join(path,field),"is not a known field")
+      return okay
+    return check
+
+def _join(path,key):
+  return "{0}.{1}".format(path,key) if path else str(key)
+
+def _fail(errors,path,message):
+  if errors is not None:
+    errors.append("{0}: {1}".format(path or "<top>",message))
+  return False
+
+def _simple(test,message):
+  def check(value,path,errors):
+    if test(value):
+      return True
+    return _fail(errors,path,"{0}, got {1!r}".format(message,value))
+  return check
+
+def compile_schema(schema,key=None):
+  """
+  Return the SchemaChecker for *schema*, compiling it only the first
+  time a given *key* (Default: the schema's repr) is seen.
+  """
+  key = key if key is not None else repr(schema)
+  checker = _cache.get(key)
+  if checker is None:
+    log.debug("Compiling schema")
+    checker = _cache[key] = SchemaChecker(schema)
+  return checker
@@ -8,9 +8,19 @@ create
 delete
   Delete an archive
 
+delete_batch
+  Delete several archives with one invocation. The part of the command
+  in square brackets is repeated once for every archive, e.g.
+  ``-d [-f $archive_name]``. Optional; without it archives are
+  deleted one at a time with *delete*.
+
 restore
   Recover an archive
 
+list
+  Print the name of every archive the service holds, one per line.
+  Optional; ``centrifuge state --reconcile`` needs it.
+
 Python (3) style named interpolation is allowed in the commands. There are
 several universally defined variables that will be interpolated into commands
 when they are run.  These are:
@@ -32,11 +42,86 @@ Example::
 
 This defines the **tarsnap** service, with the commands *create* and
 *delete*.
+
+A service can also say how to read statistics out of what *create*
+prints, with a *stats* mapping of statistic names to regular
+expressions. Each expression is matched against the end of the output
+(line by line, so ``^`` anchors a line) and its first group is read as
+a size, with or without a unit like ``MB`` or ``GiB``. Centrifuge's
+``state --stats`` report knows about *size*, *compressed* and *new*
+(the bytes the archive added to the service), but any name can be
+recorded::
+
+  tarsnap:
+    stats:
+      size: '^This archive\s+([\d.]+(?: \S*B)?)'
+      new: '^New data\s+[\d.]+(?: \S*B)?\s+([\d.]+(?: \S*B)?)'
+
+Commands can be bounded. *timeout* is the longest a command may run,
+*stall_timeout* the longest it may go without printing anything; a
+command that exceeds either is killed along with everything it
+started. A failed command is retried *retries* times, with
+exponential backoff starting at *retry_delay*; *retry_on* restricts
+that to the listed exit statuses (commands that were killed are
+always retried). Each setting applies to every command, or to one
+command with its name appended::
+
+  tarsnap:
+    timeout: 6h
+    stall_timeout: 30m
+    retries: 2
+    retry_delay: 1m
+    timeout_list: 10m
+
+Commands are split into arguments the way a shell would when the spec
+is loaded, so quoted arguments (``--configfile "/My Keys/t.conf"``)
+stay whole, and a spec with unbalanced quotes fails to load.
+
+By default the files to back up are appended to *create*'s
+arguments. Long file lists can run into the system's argument length
+limit, so a service can take them another way instead, with *files*:
+
+args
+  Append them to the command (the default).
+
+list
+  Write them to a temporary file whose path is interpolated into
+  *create* as *file_list*.
+
+stdin
+  Feed them to *create* on its standard input.
+
+The names in a list are separated by NUL characters, or by newlines
+with ``files_delimiter: newline``::
+
+  tarsnap:
+    files: list
+    cmd_create: "$var_bin --null -T $file_list -cf $archive_name"
+
+A service that can leave files out of an archive itself says how with
+*exclude*, which is added to *create* once for every glob an archive
+excludes, with the glob as *pattern*. Without it, or when an archive
+excludes by regular expression, Centrifuge works out which files are
+left itself (see the excludes module). It can only hand over whole
+subtrees, so the directories leading to something excluded are not
+archived themselves, only what is left in them, and a restore
+recreates them without their mode and owner::
+
+  tarsnap:
+    exclude: "--exclude $pattern"
 """
+import os
+import re
 import yaml
+import shlex
+import tempfile
 import logging
-import subprocess
 import string
+import argparse
+
+import runner
+import metrics
+import util
 
 
 log = logging.getLogger("centrifuge.service")
@@ -46,10 +131,50 @@ __ALL__ = [ "ServiceDefinitionError",
             "BackupService"
           ]
 
+# Headroom for the environment growing underneath us and for the
+# per-argument pointers the kernel also counts against ARG_MAX.
+ARG_MAX_SLACK = 4096
+
+# How create can be handed the files to back up.
+FILE_MODES = ("args","list","stdin")
+
+FILE_DELIMITERS = {
+  "null": "\0",
+  "newline": "\n"
+}
+
+def _argv_size(args):
+  return sum(len(arg) + 1 + 8 for arg in args)
+
+def _split(name,key,template):
+  """
+  Split the command *template* of service *name*'s *key* into argument
+  templates the way a shell would.
+  """
+  if isinstance(template,unicode):
+    template = template.encode('utf-8')
+  try:
+    return shlex.split(template)
+  except ValueError as e:
+    raise ServiceDefinitionError("{0}: can't split {1} into arguments [{2}]".format(name,key,e))
+
+def _command(args,**values):
+  """ Interpolate *values* into each of the argument templates *args* """
+  return [string.Template(arg).safe_substitute(values) for arg in args]
+
+def _arg_limit():
+  """ How many bytes of arguments we can safely pass to a command """
+  try:
+    arg_max = os.sysconf("SC_ARG_MAX")
+  except (ValueError,OSError):
+    arg_max = 131072
+  env_size = sum(len(k) + len(v) + 2 + 8 for k,v in os.environ.iteritems())
+  return arg_max - env_size - ARG_MAX_SLACK
+
 class ServiceLoadError(Exception):
   msg = "Treated '{0}' as {1}. Failed to load [{2}]"
   def __init__(self,arg,believed_type,err):
-    self.msg.format(arg,believed_type,err)
+    Exception.__init__(self,self.msg.format(arg,believed_type,err))
     self.err = err
 
 class ServiceDefinitionError(Exception):
@@ -64,16 +189,61 @@ class BackupService(object):
   commands = {
     "create": None,
     "delete": None,
-    "restore": None
+    "delete_batch": None,
+    "restore": None,
+    "list": None
   }
 
-  def __init__(self, name,cmds, spec_vars):
+  BATCH_GROUP = re.compile(r"\[([^\]]*)\]")
+
+  # The settings that bound commands, and how to read each of them.
+  LIMIT_SETTINGS = {
+    "timeout": util.parse_duration,
+    "stall_timeout": util.parse_duration,
+    "retries": int,
+    "retry_delay": util.parse_duration,
+    "retry_on": lambda statuses: [int(status) for status in
+                                  (statuses if isinstance(statuses,list) else [statuses])]
+  }
+
+  FILE_LIST = re.compile(r"\$(?:file_list\b|\{file_list\})")
+
+  def __init__(self, name,cmds, spec_vars,stats=None,limits=None,
+               files="args",files_delimiter="null",exclude=None):
     """
     Build a BackupService object with the commands specified by
-    *cmds*, with the variables specified by *spec_vars*.
+    *cmds*, with the variables specified by *spec_vars*. *stats* maps
+    statistic names to the expressions that read them from the output
+    of *create*. *limits* holds the LIMIT_SETTINGS of the spec.
+    *files* is one of FILE_MODES, how *create* takes the files to back
+    up, and *files_delimiter* separates them in a list. *exclude* is
+    the argument(s) that leave files matching *$pattern* out of an
+    archive, if the service can do that itself.
     """
 
     self.name = name
+    if files not in FILE_MODES:
+      raise ServiceDefinitionError("{0}: files must be one of {1}".format(
+                                      name,", ".join(FILE_MODES)))
+    if files_delimiter not in FILE_DELIMITERS:
+      raise ServiceDefinitionError("{0}: files_delimiter must be one of {1}".format(
+                                      name,", ".join(sorted(FILE_DELIMITERS))))
+    self.file_mode = files
+    self.file_delimiter = FILE_DELIMITERS[files_delimiter]
+    if exclude is not None:
+      try:
+        exclude = string.Template(exclude).substitute(spec_vars,pattern="$pattern")
+      except KeyError as e:
+        log.error("{1} specification requires {0} variable.".format(e,name))
+        raise ServiceDefinitionError
+      if "$pattern" not in exclude:
+        raise ServiceDefinitionError("{0}: exclude needs $pattern".format(name))
+    self.exclude = exclude
+    self.stats = self._compile_stats(name,stats)
+    self.limits = self._compile_limits(name,limits or {})
+    # Each service needs its own copy; the class attribute only lists
+    # the commands we know about.
+    self.commands = dict(BackupService.commands)
     for command in self.commands:
       spec_key = "cmd_{0}".format(command)
       try:
@@ -83,17 +253,117 @@ class BackupService(object):
       else:
         try:
           # We substitute archive_name as $archive_name to keep it in the string
-          spec_vars.update({'archive_name': "$archive_name"})
+          spec_vars.update({'archive_name': "$archive_name",'file_list': "$file_list"})
           self.commands[command] = string.Template(newcommand).substitute(spec_vars)
         except KeyError as e:
           log.error("{1} specification requires {0} variable.".format(e,name))
           raise ServiceDefinitionError
 
+    if self.delete_batch and not self.BATCH_GROUP.search(self.delete_batch):
+      raise ServiceDefinitionError(
+          "{0}: cmd_delete_batch needs a [...] group to repeat per archive".format(name))
+
+    # Commands are split once, here, so a spec that can't be split
+    # fails to load instead of failing every time a command runs.
+    self.argv = dict((command,_split(name,"cmd_{0}".format(command),template))
+                     for command,template in self.commands.iteritems() if template)
+    if self.delete_batch:
+      group = self.BATCH_GROUP.search(self.delete_batch)
+      self._batch_argv = (_split(name,"cmd_delete_batch",self.delete_batch[:group.start()]),
+                          _split(name,"cmd_delete_batch",group.group(1)),
+                          _split(name,"cmd_delete_batch",self.delete_batch[group.end():]))
+      if not self.delete:
+        self.argv['delete'] = _split(name,"cmd_delete_batch",
+                                     self.BATCH_GROUP.sub(lambda m: m.group(1),self.delete_batch))
+    self._exclude_argv = _split(name,"exclude",exclude) if exclude is not None else None
+
+    if self.create:
+      wants_list = bool(self.FILE_LIST.search(self.create))
+      if self.file_mode == "list" and not wants_list:
+        raise ServiceDefinitionError(
+            "{0}: files: list needs $file_list in cmd_create".format(name))
+      if self.file_mode != "list" and wants_list:
+        raise ServiceDefinitionError(
+            "{0}: cmd_create uses $file_list, but files isn't 'list'".format(name))
+
+  @staticmethod
+  def _compile_stats(name,stats):
+    if not stats:
+      return {}
+    if not isinstance(stats,dict):
+      raise ServiceDefinitionError("{0}: stats must map names to expressions".format(name))
+    compiled = {}
+    for stat,expression in stats.iteritems():
+      try:
+        compiled[stat] = re.compile(expression,re.MULTILINE)
+      except (re.error,TypeError) as e:
+        raise ServiceDefinitionError("{0}: bad expression for stat '{1}' [{2}]".format(
+                                        name,stat,e))
+      if compiled[stat].groups < 1:
+        raise ServiceDefinitionError("{0}: expression for stat '{1}' needs a group".format(
+                                        name,stat))
+    return compiled
+
+  @classmethod
+  def _compile_limits(cls,name,settings):
+    """ The runner.Limits of every command, from *settings* """
+    for key in settings:
+      # Catch a misspelt command name before it silently does nothing.
+      if not any(key == setting or
+                 (key.startswith(setting + "_") and key[len(setting) + 1:] in cls.commands)
+                 for setting in cls.LIMIT_SETTINGS):
+        raise ServiceDefinitionError("{0}: unknown setting '{1}'".format(name,key))
+
+    limits = {}
+    for command in cls.commands:
+      values = {}
+      for setting,convert in cls.LIMIT_SETTINGS.iteritems():
+        key = "{0}_{1}".format(setting,command)
+        if key not in settings:
+          key = setting
+        if key not in settings:
+          continue
+        try:
+          values[setting] = convert(settings[key])
+        except (ValueError,TypeError,argparse.ArgumentTypeError) as e:
+          raise ServiceDefinitionError("{0}: bad value for '{1}' [{2}]".format(name,key,e))
+      if values.get('retries',0) < 0:
+        raise ServiceDefinitionError("{0}: retries can't be negative".format(name))
+      limits[command] = runner.Limits(timeout=values.get('timeout'),
+                                      stall=values.get('stall_timeout'),
+                                      retries=values.get('retries',0),
+                                      retry_delay=values.get('retry_delay',30),
+                                      retry_on=values.get('retry_on'))
+    return limits
+
+  def parse_stats(self,output):
+    """
+    Read this service's statistics out of *output*. Returns a dict of
+    statistic names to byte counts, leaving out any that didn't match.
+    """
+    parsed = {}
+    for stat,expression in self.stats.iteritems():
+      matches = list(expression.finditer(output))
+      if not matches:
+        log.debug("{0}: no '{1}' in the output".format(self.name,stat))
+        continue
+      # The summary comes last; anything earlier is the archive's own chatter.
+      value = util.parse_size(matches[-1].group(1))
+      if value is None:
+        log.debug("{0}: can't read '{1}' as a size for '{2}'".format(
+                    self.name,matches[-1].group(1),stat))
+      else:
+        parsed[stat] = value
+    return parsed
 
   @property
   def delete(self):
     return self.commands['delete']
 
+  @property
+  def delete_batch(self):
+    return self.commands['delete_batch']
+
   @property
   def create(self):
     return self.commands['create']
@@ -102,80 +372,180 @@ class BackupService(object):
   def restore(self):
     return self.commands['restore']
 
-  def trim(self,interval,local_state, keep):
-    """
-    Delete *interval* backups known in *state* until only *keep*
-    newest are left.
-    """
-    okay = True
-    candidates = local_state[interval]
-    if len(candidates) <= keep:
-      return
-
-    for candidate in sorted(candidates,key=lambda x: x.date_created)[keep:]:
-
-      del_cmd = string.Template(self.delete).safe_substitute(archive_name=str(candidate))
-
-      try:
-        result = subprocess.check_output(del_cmd.split(),stderr=subprocess.STDOUT)
-      except subprocess.CalledProcessError,e:
-        log.warn("Failed to trim archive '{0}' [{1}]".format(candidate,e))
-        okay = False
-      else:
-        local_state[interval].remove(candidate)
-        log.info("Trimmed {0}. ".format(candidate))
-        log.debug("Service output: {0}".format(result))
-
-    return okay
-
+  @property
+  def list(self):
+    return self.commands['list']
 
-  def rotate(self,interval,local_state, files):
-    """ Delete an old backup and add a new one """
-    log.info("Rotating {0}".format(interval))
-    okay=True
-    to_delete = local_state.get_oldest(interval)
-    if to_delete:
+  def delete_archives(self,archives):
+    """
+    Delete every archive in *archives*, using as few service
+    invocations as possible.
 
-      del_cmd = string.Template(self.delete).safe_substitute(archive_name=str(to_delete))
+    Yields a ``(archives, error)`` tuple for every invocation, where
+    *error* is None if that invocation succeeded. A failed batch is
+    retried one archive at a time, so that one bad archive name
+    doesn't keep the rest of its batch around.
+    """
+    if not self.delete_batch:
+      batches = [([archive],self._delete_cmd(archive)) for archive in archives]
+    elif len(archives) == 1:
+      batches = [(archives,self._delete_cmd(archives[0]))]
+    else:
+      batches = self._batch_delete_cmds(archives)
 
+    for batch,cmd in batches:
+      limits = self.limits['delete_batch' if len(batch) > 1 else 'delete']
       try:
-        result = subprocess.check_output(del_cmd.split(),stderr=subprocess.STDOUT)
-      except subprocess.CalledProcessError,e:
-        log.warn("Failed to remove '{0}' while rotating. [{1}]".format(
-                        to_delete,e))
-        okay=False
+        result = runner.run(cmd,log,limits=limits)
+      except runner.CommandError as e:
+        metrics.record_command("delete",e.result,service=self.name,archives=len(batch))
+        if len(batch) == 1:
+          yield batch,e
+          continue
+        log.warn("Batch delete of {0} archives failed. Retrying one at a time [{1}]".format(
+                    len(batch),e))
+        for archive in batch:
+          for single in self.delete_archives([archive]):
+            yield single
       else:
-        local_state[interval].remove(to_delete)
-        log.info("Removed {0}. ".format(to_delete))
-        log.debug("Service output: {0}".format(result))
-
-    self.add(interval,local_state, files)
-
-    return okay
+        metrics.record_command("delete",result,service=self.name,archives=len(batch))
+        log.debug("Deleted {0} archives in {1:.1f}s".format(len(batch),result.elapsed))
+        yield batch,None
 
+  def _delete_cmd(self,archive):
+    """ The single-archive delete command for *archive* """
+    return _command(self.argv['delete'],archive_name=str(archive))
 
-  def add(self,interval,local_state, files):
-    """ Add a new backup instance via this service """
+  def _batch_delete_cmds(self,archives):
+    """
+    Split *archives* into ``(batch, cmd)`` chunks whose command
+    lines stay under ARG_MAX.
+    """
+    head,item,tail = self._batch_argv
+
+    limit = _arg_limit() - _argv_size(head + tail)
+    batches = []
+    batch,args,size = [],[],0
+    for archive in archives:
+      item_args = _command(item,archive_name=str(archive))
+      item_size = _argv_size(item_args)
+      if batch and size + item_size > limit:
+        batches.append((batch,head + args + tail))
+        batch,args,size = [],[],0
+      batch.append(archive)
+      args.extend(item_args)
+      size += item_size
+
+    if batch:
+      batches.append((batch,head + args + tail))
+
+    return batches
+
+  def exclude_args(self,excludes):
+    """
+    The arguments that have this service leave out what *excludes*
+    (an excludes.Excludes) matches, or None if it can't do that itself.
+    """
+    if excludes.regexes or (excludes and not self.exclude):
+      return None
+    args = []
+    for pattern in excludes.globs:
+      args.extend(_command(self._exclude_argv,pattern=pattern))
+    return args
+
+  def add(self,interval,local_state, files,excludes=None,created=None):
+    """
+    Add a new backup instance via this service, of *files* less
+    whatever *excludes* (an excludes.Excludes) matches. The instance
+    is named after *created* if given, and the current time otherwise.
+    """
     okay=True
 
-    newbackup = local_state.create_instance(interval)
-    create_cmd = (string.Template(self.create)
-                    .safe_substitute(archive_name=str(newbackup))
-                    .split())
-    create_cmd.extend(files)
-
+    newbackup = local_state.create_instance(interval,created)
+    file_list = None
     try:
-      result = subprocess.check_output(create_cmd,stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError,e:
+      exclude_args = []
+      if excludes:
+        exclude_args = self.exclude_args(excludes)
+        if exclude_args is None:
+          exclude_args = []
+          files = list(excludes.expand(files))
+          if not files:
+            raise ValueError("every file is excluded")
+
+      if self.file_mode != "args":
+        file_list = self._write_file_list(files)
+      create_cmd = _command(self.argv['create'],archive_name=str(newbackup),
+                            file_list=file_list or "")
+      create_cmd.extend(exclude_args)
+      if self.file_mode == "args":
+        create_cmd.extend(files)
+        if _argv_size(create_cmd) > _arg_limit():
+          log.warn("{0}: {1} files are too many to pass as arguments. "
+                   "Consider 'files: list' for this service".format(self.name,len(files)))
+
+      result = runner.run(create_cmd,log,limits=self.limits['create'],
+                          stdin=file_list if self.file_mode == "stdin" else None)
+    except (IOError,OSError,ValueError) as e:
+      log.warn("failed to add archive: can't build its file list [{0}]".format(e))
+      okay=False
+    except runner.CommandError as e:
+      metrics.record_command("create",e.result,service=self.name,
+                             backup=local_state.backup_name)
       log.warn("failed to add archive: [{0}]".format(e))
       okay=False
     else:
-      log.info("Added {0}. ".format(newbackup))
-      log.debug("Service Output: {0}".format(result))
+      metrics.record_command("create",result,service=self.name,
+                             backup=local_state.backup_name)
+      log.info("Added {0} in {1:.1f}s ({2} bytes of output). ".format(
+                  newbackup,result.elapsed,result.bytes_read))
+      if self.stats:
+        newbackup.stats = self.parse_stats(result.output)
       local_state.add_instance(newbackup)
+    finally:
+      if file_list:
+        os.unlink(file_list)
 
     return okay
 
+  def _write_file_list(self,files):
+    """
+    Write *files* to a temporary file, each one ended by this
+    service's delimiter. Returns its path; the caller removes it.
+    """
+    fd,path = tempfile.mkstemp(prefix="centrifuge-files-")
+    try:
+      with os.fdopen(fd,'wb') as listfile:
+        for name in files:
+          if isinstance(name,unicode):
+            name = name.encode('utf-8')
+          if self.file_delimiter in name:
+            raise ValueError("'{0}' contains the list delimiter".format(name))
+          listfile.write(name + self.file_delimiter)
+    except Exception:
+      os.unlink(path)
+      raise
+    return path
+
+  def inventory(self):
+    """
+    Return the set of archive names this service holds, fetched with
+    a single *list* command. Raises runner.CommandError if that fails.
+    """
+    if not self.list:
+      raise ServiceDefinitionError("{0} has no cmd_list".format(self.name))
+    try:
+      result = runner.run(list(self.argv['list']),log,collect=True,limits=self.limits['list'])
+    except runner.CommandError as e:
+      metrics.record_command("list",e.result,service=self.name,archives=0)
+      raise
+    archives = set(line.strip() for line in result.lines)
+    archives.discard("")
+    metrics.record_command("list",result,service=self.name,archives=len(archives))
+    log.debug("{0} holds {1} archives ({2:.1f}s to list)".format(
+                self.name,len(archives),result.elapsed))
+    return archives
+
   @classmethod
   def LoadSpecs(cls,specs,userspec=None):
     """
@@ -193,20 +563,28 @@ class BackupService(object):
 
   @staticmethod
   def _load(spec):
-    try:
-      loaded_spec = yaml.safe_load(spec)
-    except yaml.YAMLError, e:
-      log.warn("Attempt to load '{0}' as file or string "
-               "failed.".format(str(spec)))
+    """
+    Load *spec*, which is either the path to a specification file or
+    the specification itself.
+    """
+    if os.path.isfile(spec):
       try:
-        loaded_spec = yaml.safe_load(open(spec))
-      except Exception,e:
-        log.warn("Failed to load service specification '{0}'.".format(str(spec)))
+        with open(spec) as specfile:
+          loaded_spec = yaml.safe_load(specfile)
+      except (IOError,yaml.YAMLError) as e:
+        log.warn("Failed to load service specification '{0}'.".format(spec))
         raise ServiceLoadError(spec,"filename",e)
-    finally:
-      if not loaded_spec:
-        raise ServiceDefinitionError("Empty service specification")
-      return loaded_spec # if we have one.
+    else:
+      try:
+        loaded_spec = yaml.safe_load(spec)
+      except yaml.YAMLError as e:
+        raise ServiceLoadError(spec,"string",e)
+
+    if not loaded_spec:
+      raise ServiceDefinitionError("Empty service specification")
+    if not isinstance(loaded_spec,dict):
+      raise ServiceLoadError(spec,"specification","not a mapping of services")
+    return loaded_spec
 
   @classmethod
   def _parse(classname,loaded_specfile,uservars=dict()):
@@ -230,8 +608,15 @@ class BackupService(object):
                         in details.iteritems()
                         if key.startswith("cmd_")])
 
+      spec_limits = dict([(key,val)
+                          for key,val
+                          in details.iteritems()
+                          if key.startswith(tuple(classname.LIMIT_SETTINGS))])
+
       try:
-        service = classname(service,spec_cmds,spec_vars)
+        service = classname(service,spec_cmds,spec_vars,details.get('stats'),spec_limits,
+                            details.get('files',"args"),details.get('files_delimiter',"null"),
+                            details.get('exclude'))
       except ServiceDefinitionError, e:
         raise e
 
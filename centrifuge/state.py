@@ -1,9 +1,31 @@
 import centrifuge
-from datetime import date
+from datetime import datetime,timedelta
 import yaml
+import bisect
+import re
 import logging
+import threading
+import util
+import intervals
+import stats
 log = logging.getLogger("centrifuge.state")
 
+# Guards every State mutation, so that archives running in parallel
+# workers can't interleave with each other or with the state dump.
+lock = threading.RLock()
+
+# The built-in intervals every State starts out with. Others are
+# added as they are configured.
+INTERVALS = ('daily','weekly','monthly')
+
+# How new archive names carry their creation time.
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%S"
+LEGACY_DATE_FORMAT = "%d-%m-%y"
+
+# <backup>_<created>_<interval>. Backup and interval names may contain
+# underscores themselves, so the creation time is what anchors it.
+ARCHIVE_NAME = re.compile(r"^(?P<name>.+)_(?P<created>\d{8}T\d{6}|\d{2}-\d{2}-\d{2})_(?P<interval>.+)$")
+
 class StateParseError(Exception):
   pass
 
@@ -18,19 +40,53 @@ class PropertyDict(dict):
 
 class BackupInstance(yaml.YAMLObject):
 
+  # What the service reported about the archive (see service.py), as
+  # a dict of statistic names to byte counts. None if it reported
+  # nothing, as for every instance recorded before stats existed.
+  stats = None
+
   def __init__(self,archive_name, interval, date_created=None):
     self.name = archive_name
     self.interval =interval
-    self.date_created = date.today() if not date_created else date_created
+    self.date_created = (datetime.now().replace(microsecond=0)
+                          if not date_created else date_created)
 
   def __repr__(self):
     return ("{{name: {0}, created: {1}, interval: {2}}}"
                 .format(self.name,self.date_created,self.interval))
 
   def __str__(self):
-    return "{0}_{2}_{1}".format(self.name,
-                                self.interval,
-                                self.date_created.strftime("%d-%m-%y"))
+    # Instances created before sub-daily intervals only recorded the
+    # date, and their archives are named that way.
+    if isinstance(self.date_created,datetime):
+      created = self.date_created.strftime(TIMESTAMP_FORMAT)
+    else:
+      created = self.date_created.strftime(LEGACY_DATE_FORMAT)
+    return "{0}_{2}_{1}".format(self.name,self.interval,created)
+
+  @classmethod
+  def Parse(cls,archive):
+    """
+    Rebuild the instance an archive called *archive* was created for.
+    Returns None if the name isn't one Centrifuge would have made.
+    """
+    match = ARCHIVE_NAME.match(archive)
+    if not match:
+      return None
+    created = match.group('created')
+    try:
+      if "T" in created:
+        date_created = datetime.strptime(created,TIMESTAMP_FORMAT)
+      else:
+        date_created = datetime.strptime(created,LEGACY_DATE_FORMAT).date()
+    except ValueError:
+      return None
+    return cls(match.group('name'),match.group('interval'),date_created)
+
+  @property
+  def created_at(self):
+    """ When this instance was created, always as a datetime """
+    return intervals.as_datetime(self.date_created)
 
   @classmethod
   def to_yaml(cls,dumper,data):
@@ -43,6 +99,13 @@ class BackupInstance(yaml.YAMLObject):
 
 class State(PropertyDict):
 
+  # The StateStore this state reports its changes to, if any.
+  journal = None
+  # What new instances are named after, if not backup_name. An archive
+  # backed up to several services keeps a state for each of them, but
+  # its archives are named the same on all of them.
+  archive_name = None
+
   def __init__(self,backup_name,statedict=None):
     self.backup_name = backup_name
     if statedict:
@@ -55,31 +118,135 @@ class State(PropertyDict):
       self['weekly'] = []
       self['monthly'] = []
 
-  def create_instance(self,interval):
+  def create_instance(self,interval,created=None):
     """
     Create a new backup instance, but don't add it to
     the list yet.
 
-    Return a tuple containing the new_instance and the new
-    'latest_key' that it belongs to.
+    The instance is named after the time it was created (or
+    *created*, to give several instances the same name). Should that
+    name already belong to the latest instance of *interval* (two runs
+    in the same second, or a clock that went backwards) the new one is
+    moved to just after it instead.
     """
-    newinstance = BackupInstance(self.backup_name,interval)
+    newinstance = BackupInstance(self.archive_name or self.backup_name,interval,created)
+
+    latest = self.get("last_{0}".format(interval))
+    if latest is not None and latest.created_at >= newinstance.created_at:
+      newinstance.date_created = latest.created_at + timedelta(seconds=1)
 
     return newinstance
 
+  def tier(self,interval):
+    """
+    The instances kept for *interval*, oldest first. Created empty
+    the first time an interval is used.
+    """
+    return self.setdefault(interval,[])
+
+  def intervals(self):
+    """ The names of every interval this state keeps instances for """
+    tiers = [key for key,value in self.iteritems() if isinstance(value,list)]
+    return ([interval for interval in INTERVALS if interval in tiers]
+            + sorted(interval for interval in tiers if interval not in INTERVALS))
+
+  def sort_tiers(self):
+    """ Put every tier in creation order """
+    for interval in self.intervals():
+      self[interval].sort(key=lambda x: x.created_at)
+
+  def _insert(self,interval,instance):
+    # Tiers stay sorted, so the oldest instances are always at the
+    # front. New instances nearly always belong at the end.
+    tier = self.tier(interval)
+    if not tier or tier[-1].created_at <= instance.created_at:
+      tier.append(instance)
+    else:
+      keys = [x.created_at for x in tier]
+      tier.insert(bisect.bisect_right(keys,instance.created_at),instance)
+
   def add_instance(self,instance):
     """
     Add the backup instance *instance* to this state object
     """
-    if instance in self[instance.interval]:
-      logging.debug("Backup instance '{0}' already exists in state file.".format(instance) +
-                    " Will not add again")
-      return
+    with lock:
+      if instance in self.tier(instance.interval):
+        logging.debug("Backup instance '{0}' already exists in state file.".format(instance) +
+                      " Will not add again")
+        return
 
-    self[instance.interval].append(instance)
+      self._insert(instance.interval,instance)
 
-    latest_key = "last_{0}".format(instance.interval)
-    self[latest_key] = instance
+      latest_key = "last_{0}".format(instance.interval)
+      self[latest_key] = instance
+      if self.journal:
+        self.journal.record_add(self,instance.interval,instance)
+
+  def tag_instance(self,instance,interval):
+    """
+    Tag the existing backup instance *instance* into *interval* as
+    well, without creating a new archive.
+    """
+    with lock:
+      if instance not in self.tier(interval):
+        self._insert(interval,instance)
+      self["last_{0}".format(interval)] = instance
+      if self.journal:
+        self.journal.record_add(self,interval,instance)
+
+  def adopt_instance(self,instance):
+    """
+    Add *instance*, an archive that exists but that this state had
+    lost track of. Unlike add_instance it only becomes the latest of
+    its interval if it is newer than the one we know.
+    """
+    with lock:
+      self._insert(instance.interval,instance)
+      latest_key = "last_{0}".format(instance.interval)
+      latest = self.get(latest_key)
+      newest = latest is None or latest.created_at < instance.created_at
+      if newest:
+        self[latest_key] = instance
+      if self.journal:
+        self.journal.record_add(self,instance.interval,instance,latest=newest)
+
+  def remove_instance(self,interval,instance):
+    """
+    Forget the backup instance *instance* from *interval*
+    """
+    with lock:
+      self[interval].remove(instance)
+      if self.journal:
+        self.journal.record_remove(self,interval,[instance])
+
+  def remove_instances(self,interval,instances):
+    """
+    Forget every backup instance in *instances* from *interval*
+    """
+    with lock:
+      gone = set(id(instance) for instance in instances)
+      tier = self[interval]
+      tier[:] = [instance for instance in tier if id(instance) not in gone]
+      if self.journal:
+        self.journal.record_remove(self,interval,instances)
+
+  def is_shared(self,instance,interval):
+    """
+    Return True if an interval other than *interval* still
+    references *instance*.
+    """
+    with lock:
+      return str(instance) in self.held_elsewhere(interval)
+
+  def held_elsewhere(self,interval):
+    """
+    The names of every archive that an interval other than
+    *interval* still references.
+    """
+    with lock:
+      return set(str(instance)
+                 for other in self.intervals() if other != interval
+                 for instance in self[other])
 
   def add_to_interval(self,interval):
     """
@@ -100,11 +267,10 @@ class State(PropertyDict):
     return newinstance
 
   def get_oldest(self,interval):
-    if interval not in self:
-      raise service.ServiceDefinitionError("invalid interval requested")
-    if len(self[interval]) == 0:
+    tier = self.get(interval)
+    if not tier:
       return None
-    return sorted(self[interval],key=lambda x: x.date_created)[0]
+    return tier[0]
 
   @classmethod
   def ParseFile(cls,statefilepath):
@@ -115,7 +281,7 @@ class State(PropertyDict):
           if len(statestr) < 1:
             raise IOError
 
-          yamlobj = yaml.load(statestr)
+          yamlobj = yaml.load(statestr,Loader=yaml.Loader)
 
         except yaml.YAMLError,e:
           raise StateParseError("Unable to parse state. [{0}]".format(e))
@@ -158,40 +324,82 @@ class State(PropertyDict):
     mg = parser.add_mutually_exclusive_group(required=True)
     mg.add_argument("-l", "--list",action="store_true",
                     help="List known backups present in the state file")
-    parser.set_defaults(func=cls.actions)
+    mg.add_argument("--migrate",action="store_true",
+                    help="Move the YAML state file into an SQLite state database")
+    mg.add_argument("--reconcile",action="store_true",
+                    help="Compare the state with the archives each service really has, "
+                         "adopting and forgetting archives to match")
+    mg.add_argument("--stats",action="store_true",
+                    help="Report the size, new data, churn and deduplication of "
+                         "each backup's archives")
+
+    rg = parser.add_argument_group("reconcile options")
+    rg.add_argument("-c","--config",type=str,
+                    help="Backup configuration file, or a directory of configuration files")
+    rg.add_argument("--uservars",
+                    help="User variable specification file (Default ~/.centrifuge/user.vars)",
+                    default="~/.centrifuge/user.vars")
+    rg.add_argument("-n","--dry-run",action="store_true",
+                    help="Only show what would be adopted and forgotten")
+    rg.add_argument("--max-age",type=util.parse_duration,default=15 * 60,metavar="AGE",
+                    help="Reuse a service's archive list fetched less than AGE ago (Default 15m)")
+    rg.add_argument("--refresh",action="store_true",
+                    help="Always fetch the archive lists again")
+
+    sg = parser.add_argument_group("stats options")
+    sg.add_argument("--sort",choices=stats.SORT_KEYS,default='new',
+                    help="Order the report by this column (Default new; "
+                         "dedup puts the worst first)")
+    parser.set_defaults(func=cls.actions,needs_state=True)
 
     return parser
 
+  def __getstate__(self):
+    # The journal is a live connection, not part of the state.
+    attrs = self.__dict__.copy()
+    attrs.pop('journal',None)
+    return attrs
+
   def __str__(self):
     ret = ""
 
-    ret += "    Daily:\n"
-    for daily in self['daily']:
-      ret +="      - {0}\n".format(str(daily))
-
-    ret += "    Weekly:\n"
-    for weekly in self['weekly']:
-      ret +="      - {0}\n".format(str(weekly))
-
-    ret += "    Monthly:\n"
-    for monthly in self['monthly']:
-      ret +="      - {0}\n".format(str(monthly))
+    for interval in self.intervals():
+      ret += "    {0}:\n".format(interval.capitalize())
+      for instance in self[interval]:
+        ret +="      - {0}\n".format(str(instance))
 
     return ret
 
   @staticmethod
-  def actions(args,state):
+  def actions(args,state,store=None,**kwargs):
     """
     Handle command line actions that want to deal with the statefile.
     """
+    import statestore
 
     if args.list == True:
       for name,instance in state.iteritems():
         print("Backup: {0}".format(name))
         print(instance)
+    elif args.migrate == True:
+      if not isinstance(store,statestore.YAMLStateStore):
+        raise centrifuge.CentrifugeFatalError("State is already stored in SQLite")
+      store.migrate(centrifuge.Centrifuge.STATE_DB)
+    elif args.reconcile == True:
+      return kwargs['centrifuge'].reconcile_inventory(args=args)
+    elif args.stats == True:
+      rows = stats.summarize(state)
+      if not rows:
+        print("No archive statistics recorded yet")
+      else:
+        print(stats.format_report(rows,args.sort))
+        if len(rows) < len(state):
+          print("\n{0} backups have no statistics".format(len(state) - len(rows)))
     else:
       raise centrifuge.CentrifugeFatalError("Unrecognized command line argument")
 
+    return True
+
 
 
 
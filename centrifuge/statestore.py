@@ -0,0 +1,380 @@
+"""
+Where Centrifuge keeps its State between runs.
+
+YAMLStateStore keeps every archive's state in one YAML file that is
+rewritten as a whole. SQLiteStateStore records each change as its own
+small transaction, so a run only writes what actually changed and an
+interrupted write can't truncate the history.
+
+Stores attach themselves to the State objects they hand out as the
+state's *journal*, and State reports every add/tag/remove to it. The
+DueIndex of when archives next fall due is kept the same way.
+"""
+import os
+import yaml
+import sqlite3
+import logging
+import datetime
+
+import state
+import schedule
+
+log = logging.getLogger("centrifuge.statestore")
+
+__ALL__ = [ "StateStore",
+            "YAMLStateStore",
+            "SQLiteStateStore",
+            "open_store"
+          ]
+
+class StateStore(object):
+  """
+  The interface every state backend provides.
+  """
+
+  def load(self):
+    """ Return a dict mapping backup names to their State """
+    raise NotImplementedError
+
+  def create(self,backup_name):
+    """ Return a new, empty State for *backup_name* backed by this store """
+    newstate = state.State(backup_name)
+    newstate.journal = self
+    return newstate
+
+  def record_add(self,bstate,interval,instance,latest=True):
+    """
+    *instance* was added to (or tagged into) *interval*, and is now
+    its latest instance unless *latest* is False
+    """
+    pass
+
+  def record_remove(self,bstate,interval,instances):
+    """ *instances* were removed from *interval* """
+    pass
+
+  def flush(self,states):
+    """ Make sure everything in *states* has been persisted """
+    pass
+
+  def load_schedule(self):
+    """ Return the DueIndex of the archives in this store """
+    index = schedule.DueIndex()
+    index.journal = self
+    return index
+
+  def record_schedule(self,backup,signature,dues):
+    """ The due times of *backup* changed """
+    pass
+
+  def record_unschedule(self,backup):
+    """ *backup* was dropped from the DueIndex """
+    pass
+
+  def flush_schedule(self,index):
+    """ Make sure *index* has been persisted """
+    pass
+
+  def _attach(self,states):
+    for bstate in states.itervalues():
+      bstate.journal = self
+      bstate.sort_tiers()
+    return states
+
+class YAMLStateStore(StateStore):
+  """
+  The original single file state. Changes are only written on
+  flush, which replaces the whole file atomically.
+  """
+
+  SCHEDULE_VERSION = 1
+
+  def __init__(self,path):
+    self.path = path
+    self.schedule_path = path + ".schedule"
+
+  def load(self):
+    states = state.State.ParseFile(self.path)
+    return self._attach(states if states else dict())
+
+  def flush(self,states):
+    with state.lock:
+      self._write(self.path,lambda statef: yaml.dump(states,statef))
+
+  def load_schedule(self):
+    entries = {}
+    try:
+      with open(self.schedule_path) as schedf:
+        stored = yaml.safe_load(schedf)
+    except IOError:
+      stored = None
+    except yaml.YAMLError as e:
+      log.warn("Ignoring unreadable schedule '{0}' [{1}]".format(self.schedule_path,e))
+      stored = None
+
+    # A missing or stale schedule is rebuilt from the state.
+    if stored and stored.get('version') == self.SCHEDULE_VERSION:
+      for backup,entry in stored['archives'].iteritems():
+        entries[backup] = (entry['signature'],entry['due'])
+
+    index = schedule.DueIndex(entries)
+    index.journal = self
+    return index
+
+  def flush_schedule(self,index):
+    with state.lock:
+      if not index.dirty:
+        return
+      archives = dict((backup,{'signature': signature,'due': dues})
+                      for backup,(signature,dues) in index.entries.iteritems())
+      self._write(self.schedule_path,
+                  lambda schedf: yaml.safe_dump({'version': self.SCHEDULE_VERSION,
+                                                 'archives': archives},schedf))
+      index.dirty = False
+
+  @staticmethod
+  def _write(path,dump):
+    tmppath = path + ".tmp"
+    with open(tmppath,'w') as outf:
+      dump(outf)
+    os.rename(tmppath,path)
+
+  def migrate(self,dbpath):
+    """
+    Copy this state into a new SQLite store at *dbpath* and move the
+    YAML file out of the way. Returns the new store.
+    """
+    if os.path.exists(dbpath):
+      raise state.StateParseError("'{0}' already exists".format(dbpath))
+
+    states = self.load()
+    store = SQLiteStateStore(dbpath)
+    store.import_states(states)
+    if os.path.exists(self.path):
+      os.rename(self.path,self.path + ".migrated")
+
+    log.info("Migrated {0} backups from '{1}' to '{2}'".format(
+                len(states),self.path,dbpath))
+    return store
+
+class SQLiteStateStore(StateStore):
+  """
+  State kept in an SQLite database. Every add or remove is its own
+  transaction, so flush has nothing left to do.
+  """
+
+  SCHEMA = """
+  CREATE TABLE IF NOT EXISTS instances (
+    backup TEXT NOT NULL,
+    archive TEXT NOT NULL,
+    name TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    date_created TEXT NOT NULL,
+    PRIMARY KEY (backup, archive)
+  );
+  CREATE TABLE IF NOT EXISTS tiers (
+    backup TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    archive TEXT NOT NULL,
+    PRIMARY KEY (backup, interval, archive)
+  );
+  CREATE TABLE IF NOT EXISTS latest (
+    backup TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    archive TEXT NOT NULL,
+    PRIMARY KEY (backup, interval)
+  );
+  CREATE TABLE IF NOT EXISTS stats (
+    backup TEXT NOT NULL,
+    archive TEXT NOT NULL,
+    stat TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (backup, archive, stat)
+  );
+  CREATE TABLE IF NOT EXISTS schedule (
+    backup TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    due_at TEXT NOT NULL,
+    PRIMARY KEY (backup, interval)
+  );
+  CREATE TABLE IF NOT EXISTS schedule_signatures (
+    backup TEXT PRIMARY KEY,
+    signature TEXT NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS instances_by_name ON instances (name);
+  CREATE INDEX IF NOT EXISTS instances_by_interval ON instances (interval);
+  CREATE INDEX IF NOT EXISTS instances_by_date ON instances (date_created);
+  CREATE INDEX IF NOT EXISTS tiers_by_archive ON tiers (backup, archive);
+  CREATE INDEX IF NOT EXISTS schedule_by_due ON schedule (due_at);
+  """
+
+  DATE_FORMAT = "%Y-%m-%d"
+  TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+  def __init__(self,path):
+    self.path = path
+    # Parallel workers share the connection; state.lock serializes them.
+    self.conn = sqlite3.connect(path,check_same_thread=False)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("PRAGMA synchronous=NORMAL")
+    self.conn.executescript(self.SCHEMA)
+
+  def load(self):
+    states = {}
+    instances = {}
+    with state.lock:
+      for backup,archive,name,interval,created in self.conn.execute(
+            "SELECT backup, archive, name, interval, date_created FROM instances"):
+        instances[(backup,archive)] = state.BackupInstance(
+            name,interval,self._parse_date(created))
+
+      for backup,archive,stat,value in self.conn.execute(
+            "SELECT backup, archive, stat, value FROM stats"):
+        instance = instances.get((backup,archive))
+        if instance is not None:
+          if instance.stats is None:
+            instance.stats = {}
+          instance.stats[stat] = value
+
+      for backup, in self.conn.execute("SELECT DISTINCT backup FROM instances"):
+        states[backup] = state.State(backup)
+
+      for backup,interval,archive in self.conn.execute(
+            "SELECT tiers.backup, tiers.interval, tiers.archive FROM tiers "
+            "JOIN instances USING (backup, archive) "
+            "ORDER BY instances.date_created"):
+        states[backup].setdefault(interval,[]).append(instances[(backup,archive)])
+
+      for backup,interval,archive in self.conn.execute(
+            "SELECT backup, interval, archive FROM latest"):
+        states[backup]["last_{0}".format(interval)] = instances[(backup,archive)]
+
+    return self._attach(states)
+
+  def record_add(self,bstate,interval,instance,latest=True):
+    with state.lock:
+      with self.conn:
+        self._insert(bstate.backup_name,interval,instance,latest=latest)
+
+  def record_remove(self,bstate,interval,instances):
+    with state.lock:
+      with self.conn:
+        for instance in instances:
+          self.conn.execute(
+              "DELETE FROM tiers WHERE backup = ? AND interval = ? AND archive = ?",
+              (bstate.backup_name,interval,str(instance)))
+          self._collect(bstate.backup_name,str(instance))
+
+  def load_schedule(self):
+    entries = {}
+    with state.lock:
+      for backup,signature in self.conn.execute(
+            "SELECT backup, signature FROM schedule_signatures"):
+        entries[backup] = (signature,{})
+      for backup,interval,due_at in self.conn.execute(
+            "SELECT backup, interval, due_at FROM schedule"):
+        if backup in entries:
+          entries[backup][1][interval] = self._parse_date(due_at)
+
+    index = schedule.DueIndex(entries)
+    index.journal = self
+    return index
+
+  def record_schedule(self,backup,signature,dues):
+    with state.lock:
+      with self.conn:
+        self.conn.execute("DELETE FROM schedule WHERE backup = ?",(backup,))
+        self.conn.executemany(
+            "INSERT INTO schedule (backup, interval, due_at) VALUES (?, ?, ?)",
+            [(backup,interval,self._format_date(when.replace(microsecond=0)))
+             for interval,when in dues.iteritems()])
+        self.conn.execute(
+            "INSERT OR REPLACE INTO schedule_signatures (backup, signature) VALUES (?, ?)",
+            (backup,signature))
+
+  def record_unschedule(self,backup):
+    with state.lock:
+      with self.conn:
+        self.conn.execute("DELETE FROM schedule WHERE backup = ?",(backup,))
+        self.conn.execute("DELETE FROM schedule_signatures WHERE backup = ?",(backup,))
+
+  def import_states(self,states):
+    """ Copy every State in *states* into this store in one transaction """
+    with state.lock:
+      with self.conn:
+        for backup,bstate in states.iteritems():
+          for interval in bstate.intervals():
+            for instance in bstate[interval]:
+              self._insert(backup,interval,instance,latest=False)
+            latest = bstate.get("last_{0}".format(interval))
+            if latest:
+              self._insert_instance(backup,latest)
+              self._set_latest(backup,interval,latest)
+
+  def _insert(self,backup,interval,instance,latest=True):
+    self._insert_instance(backup,instance)
+    self.conn.execute(
+        "INSERT OR IGNORE INTO tiers (backup, interval, archive) VALUES (?, ?, ?)",
+        (backup,interval,str(instance)))
+    if latest:
+      self._set_latest(backup,interval,instance)
+
+  def _insert_instance(self,backup,instance):
+    self.conn.execute(
+        "INSERT OR IGNORE INTO instances "
+        "(backup, archive, name, interval, date_created) VALUES (?, ?, ?, ?, ?)",
+        (backup,str(instance),instance.name,instance.interval,
+         self._format_date(instance.date_created)))
+    if instance.stats:
+      self.conn.executemany(
+          "INSERT OR REPLACE INTO stats (backup, archive, stat, value) VALUES (?, ?, ?, ?)",
+          [(backup,str(instance),stat,value) for stat,value in instance.stats.iteritems()])
+
+  def _set_latest(self,backup,interval,instance):
+    previous = self.conn.execute(
+        "SELECT archive FROM latest WHERE backup = ? AND interval = ?",
+        (backup,interval)).fetchone()
+    self.conn.execute(
+        "INSERT OR REPLACE INTO latest (backup, interval, archive) VALUES (?, ?, ?)",
+        (backup,interval,str(instance)))
+    if previous and previous[0] != str(instance):
+      self._collect(backup,previous[0])
+
+  def _collect(self,backup,archive):
+    """ Drop the instance row once nothing refers to it any more """
+    self.conn.execute(
+        "DELETE FROM instances WHERE backup = ? AND archive = ? "
+        "AND NOT EXISTS (SELECT 1 FROM tiers WHERE backup = ? AND archive = ?) "
+        "AND NOT EXISTS (SELECT 1 FROM latest WHERE backup = ? AND archive = ?)",
+        (backup,archive,backup,archive,backup,archive))
+    self.conn.execute(
+        "DELETE FROM stats WHERE backup = ? AND archive = ? "
+        "AND NOT EXISTS (SELECT 1 FROM instances WHERE backup = ? AND archive = ?)",
+        (backup,archive,backup,archive))
+
+  @classmethod
+  def _format_date(cls,created):
+    # Both forms sort correctly as text, and a bare date is an
+    # instance from before archives carried the time.
+    # isoformat, unlike strftime, copes with datetime.min.
+    if isinstance(created,datetime.datetime):
+      return created.isoformat(' ')
+    return created.isoformat()
+
+  @classmethod
+  def _parse_date(cls,text):
+    if len(text) > 10:
+      return datetime.datetime.strptime(text,cls.TIMESTAMP_FORMAT)
+    return datetime.datetime.strptime(text,cls.DATE_FORMAT).date()
+
+def open_store(yamlpath,dbpath):
+  """
+  Return the SQLite store at *dbpath* if it exists, otherwise the YAML
+  store at *yamlpath*.
+  """
+  if os.path.exists(dbpath):
+    log.debug("Using SQLite state '{0}'".format(dbpath))
+    return SQLiteStateStore(dbpath)
+
+  log.debug("Using YAML state '{0}'".format(yamlpath))
+  return YAMLStateStore(yamlpath)
@@ -0,0 +1,96 @@
+"""
+Report on what archives cost.
+
+Services that declare *stats* expressions record, for every archive
+they create, its size, its compressed size and how much new data it
+added. summarize rolls that up per backup over the archives the State
+still keeps:
+
+size, compressed
+  Of the newest archive.
+
+new
+  Added by all the kept archives together: roughly what keeping them
+  costs on top of everything else.
+
+churn
+  The average share of an archive that was new. High churn means most
+  of every archive is uploaded again.
+
+dedup
+  How many bytes were archived for every new byte stored. The lower
+  it is, the less the service's deduplication helps.
+"""
+import util
+
+__ALL__ = [ "summarize",
+            "format_report",
+            "SORT_KEYS"
+          ]
+
+# How the report can be ordered. Everything sorts largest first
+# except dedup, where the worst (lowest) ratio comes first.
+SORT_KEYS = ('new','churn','dedup','size')
+
+def summarize(states):
+  """
+  Return a row per backup in *states* that has statistics, as dicts
+  with the keys *backup*, *archives*, *size*, *compressed*, *new*,
+  *churn* and *dedup*. Figures that can't be worked out are None.
+  """
+  rows = []
+  for backup,bstate in states.iteritems():
+    instances = {}
+    for interval in bstate.intervals():
+      for instance in bstate[interval]:
+        if instance.stats:
+          instances[str(instance)] = instance
+    if not instances:
+      continue
+
+    ordered = sorted(instances.itervalues(),key=lambda instance: instance.created_at)
+    newest = ordered[-1].stats
+    measured = [instance.stats for instance in ordered
+                if instance.stats.get('size') and 'new' in instance.stats]
+    total_size = sum(stats['size'] for stats in measured)
+    total_new = sum(stats['new'] for stats in measured)
+
+    rows.append({
+      'backup': backup,
+      'archives': len(ordered),
+      'size': newest.get('size'),
+      'compressed': newest.get('compressed'),
+      'new': sum(instance.stats.get('new',0) for instance in ordered),
+      'churn': (sum(float(stats['new']) / stats['size'] for stats in measured) / len(measured)
+                if measured else None),
+      'dedup': float(total_size) / total_new if total_new else None
+    })
+  return rows
+
+def format_report(rows,sort='new'):
+  """ *rows* from summarize as a table, ordered by *sort* """
+  rows = sorted(rows,key=lambda row: row['backup'])
+  if sort == 'dedup':
+    # Unknown ratios (nothing new at all) are the best case.
+    key = lambda row: (row['dedup'] is None,row['dedup'])
+    rows = sorted(rows,key=key)
+  else:
+    rows = sorted(rows,key=lambda row: row[sort],reverse=True)
+
+  table = [("Backup","Archives","Size","Compressed","New","Churn","Dedup")]
+  for row in rows:
+    table.append((row['backup'],
+                  str(row['archives']),
+                  _size(row['size']),
+                  _size(row['compressed']),
+                  _size(row['new']),
+                  "-" if row['churn'] is None else "{0:.1%}".format(row['churn']),
+                  "-" if row['dedup'] is None else "{0:.1f}x".format(row['dedup'])))
+
+  widths = [max(len(line[column]) for line in table) for column in range(len(table[0]))]
+  return "\n".join("  ".join([line[0].ljust(widths[0])]
+                             + [cell.rjust(width) for cell,width in zip(line[1:],widths[1:])])
+                   for line in table)
+
+def _size(size):
+  return "-" if size is None else util.format_size(size)
@@ -0,0 +1,80 @@
+"""
+Small helpers shared by the rest of Centrifuge.
+"""
+import re
+import socket
+import hashlib
+import argparse
+
+DURATION_UNITS = {
+  's': 1,
+  'm': 60,
+  'h': 60 * 60,
+  'd': 24 * 60 * 60,
+  'w': 7 * 24 * 60 * 60
+}
+
+_DURATION = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$")
+
+def parse_duration(text):
+  """
+  Parse a duration like '90', '90s', '15m', '2h' or '1d' into seconds.
+  Bare numbers are seconds. Usable as an argparse *type*.
+  """
+  if isinstance(text,(int,long,float)):
+    return text
+  match = _DURATION.match(str(text))
+  if not match:
+    raise argparse.ArgumentTypeError("invalid duration '{0}'".format(text))
+  value,unit = match.groups()
+  return float(value) * DURATION_UNITS[unit or 's']
+
+SIZE_UNITS = {
+  '': 1,
+  'b': 1,
+  'kb': 1000,
+  'mb': 1000 ** 2,
+  'gb': 1000 ** 3,
+  'tb': 1000 ** 4,
+  'pb': 1000 ** 5,
+  'kib': 1024,
+  'mib': 1024 ** 2,
+  'gib': 1024 ** 3,
+  'tib': 1024 ** 4,
+  'pib': 1024 ** 5
+}
+
+_SIZE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgtp]?i?b)?\s*$",re.IGNORECASE)
+
+def parse_size(text):
+  """
+  Parse a size like '1234', '512 B', '1.5 MB' or '2 GiB' into bytes.
+  Returns None if *text* isn't a size.
+  """
+  match = _SIZE.match(text.replace(",",""))
+  if not match:
+    return None
+  value,unit = match.groups()
+  return int(float(value) * SIZE_UNITS[(unit or '').lower()])
+
+def format_size(size):
+  """ *size* bytes, for people """
+  for unit in ('B','kB','MB','GB','TB'):
+    if abs(size) < 1000 or unit == 'TB':
+      break
+    size /= 1000.0
+  if unit == 'B':
+    return "{0} B".format(int(size))
+  return "{0:.1f} {1}".format(size,unit)
+
+def stagger_offset(key,window,host=None):
+  """
+  A stable offset in [0, *window*) seconds for *key* on *host*
+  (Default: this host). Hosts running the same schedule get different
+  offsets, but the same host always gets the same one.
+  """
+  if window <= 0:
+    return 0.0
+  host = host if host is not None else socket.getfqdn()
+  digest = hashlib.sha1("{0}\0{1}".format(host,key)).hexdigest()
+  return (int(digest[:15],16) / float(16 ** 15)) * window